@@ -12,20 +12,38 @@
 """See docstring for JPCImporter class"""
 
 from os import path
-import subprocess
+import sys
 import plistlib
 import xml.etree.ElementTree as ET
 import datetime
 import logging
-import logging.handlers
-from time import sleep
-import requests
+from concurrent.futures import ThreadPoolExecutor
 
 from autopkglib import Processor, ProcessorError
 
+# AutoPkg doesn't put our directory on the path for the shared library
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+from PatchBotLib.client import get_client  # noqa: E402
+from PatchBotLib.ratelimit import limits  # noqa: E402
+from PatchBotLib.upload import MultipartUploader, UploadError  # noqa: E402
+from PatchBotLib.upload import HASH_TYPE  # noqa: E402
+from PatchBotLib.dedup import HashIndex  # noqa: E402
+from PatchBotLib.catalog import get_catalog, CatalogError  # noqa: E402
+from PatchBotLib.ready import wait_until, record, READY_DEADLINE  # noqa: E402
+from PatchBotLib import metrics  # noqa: E402
+from PatchBotLib.profiling import profiled  # noqa: E402
+from PatchBotLib.logs import get_logger  # noqa: E402
+
 APPNAME = "JPCImporter"
 LOGLEVEL = logging.DEBUG
-LOGFILE = "/usr/local/var/log/%s.log" % APPNAME
+
+# what we change in the TEST policy so it had better be there
+POLICY_FIELDS = (
+    "general/id",
+    "general/enabled",
+    "package_configuration/packages/package/id",
+    "package_configuration/packages/package/name",
+)
 
 __all__ = [APPNAME]
 
@@ -40,6 +58,16 @@ class JPCImporter(Processor):
             "required": False,
             "description": "Path to the package to be imported into Jamf Pro ",
         },
+        "ready_deadline": {
+            "required": False,
+            "description": "Seconds to keep trying to update the package "
+            "record after upload, default %s" % READY_DEADLINE,
+        },
+        "profile": {
+            "required": False,
+            "description": "Profile the run, the results go next to the "
+            "log file. PATCHBOT_PROFILE=1 does the same",
+        },
     }
     output_variables = {
         "pkg_path": {"description": "The created package."},
@@ -48,23 +76,7 @@ class JPCImporter(Processor):
 
     def setup_logging(self):
         """Defines a nicely formatted logger"""
-
-        self.logger = logging.getLogger(APPNAME)
-        self.logger.setLevel(LOGLEVEL)
-        # we may be the second and subsequent iterations of JPCImporter
-        # and already have a handler.
-        if len(self.logger.handlers) > 0:
-            return
-        handler = logging.handlers.TimedRotatingFileHandler(
-            LOGFILE, when="D", interval=1, backupCount=7
-        )
-        handler.setFormatter(
-            logging.Formatter(
-                "%(asctime)s %(levelname)s %(message)s",
-                datefmt="%Y-%m-%d %H:%M:%S",
-            )
-        )
-        self.logger.addHandler(handler)
+        self.logger = get_logger(APPNAME, LOGLEVEL)
 
     def load_prefs(self):
         """ load the preferences from file """
@@ -82,109 +94,146 @@ class JPCImporter(Processor):
             prefs = plistlib.load(open(plist, "rb"))
             url = prefs["url"]
             auth = (prefs["user"], prefs["password"])
-        return (url, auth)
+        try:
+            rates = limits(prefs)
+        except ValueError as err:
+            raise ProcessorError(str(err))
+        return (url, auth, rates)
+
+    def duplicate(self, index, pkg_path):
+        """Is there a package on the server with the same contents as
+        `pkg_path`? We only ask the server if our record is getting old"""
+        found = index.find(pkg_path)
+        if not found:
+            return False
+        if index.stale(found):
+            url = self.client.base + "packages/id/{}".format(found["id"])
+            self.logger.debug("About to check: %s", url)
+            ret = self.client.get(url)
+            if ret.status_code == 404:
+                index.drop(found)
+                return False
+            if ret.status_code != 200:
+                return False
+            index.checked(found)
+        self.logger.warning(
+            "Same contents as existing package: %s", found["name"]
+        )
+        return True
+
+    def exists(self, catalog, pkg):
+        """Is there already a package called `pkg`? We ask the package
+        catalog and only ask the server directly if that fails"""
+        try:
+            return catalog.find(pkg) is not None
+        except CatalogError as err:
+            self.logger.debug("Catalog failed: %s", err)
+        url = self.client.base + "packages/name/{}".format(pkg)
+        self.logger.debug("About to get: %s", url)
+        return self.client.get(url).status_code == 200
+
+    def test_policy(self, title):
+        """Fetch the TEST policy for `title` and check it has everything
+        we need to change"""
+        url = self.client.base + "policies/name/TEST-{}".format(title)
+        ret = self.client.get(url)
+        if ret.status_code != 200:
+            raise ProcessorError(
+                "Test Policy %s not found: %s" % (url, ret.status_code)
+            )
+        with metrics.timed("parse", metrics.endpoint(url)):
+            root = ET.fromstring(ret.content)
+        for field in POLICY_FIELDS:
+            if root.find(field) is None:
+                raise ProcessorError(
+                    "Test Policy %s has no %s" % (url, field)
+                )
+        return root
 
     def upload(self, pkg_path):
         """Upload the package `pkg_path` and returns the ID returned by JPC"""
         self.logger.info("Starting %s", pkg_path)
 
         # do some set up
-        (server, auth) = self.load_prefs()
-        hdrs = {"Accept": "application/xml", "Content-type": "application/xml"}
-        base = server + "/JSSResource/"
+        (server, auth, rates) = self.load_prefs()
+        # the shared client looks after the sticky cookie so we hit the
+        # same server for every request
+        self.client = get_client(server, auth, rates)
+        base = self.client.base
         pkg = path.basename(pkg_path)
         title = pkg.split("-")[0]
 
-        # let's use the cookies to make sure we hit the
-        # same server for every request.
-        # the complication here is that ordinary and Premium Jamfers
-        # get two DIFFERENT cookies for this.
-
-        # the front page will give us the cookies
-        r = requests.get(server)
-
-        cookie_value = r.cookies.get('APBALANCEID')
-        if cookie_value:
-            # we are NOT premium Jamf Cloud
-            self.cookies = dict(APBALANCEID=cookie_value)
-            c_cookie = "APBALANCEID={}".format(cookie_value)
-        else:
-            cookie_value = r.cookies['AWSALB']
-            self.cookies = dict(AWSALB=cookie_value)
-            c_cookie = "AWSALB={}".format(cookie_value)
-
-        # check to see if the package already exists
-        url = base + "packages/name/{}".format(pkg)
-        self.logger.debug("About to get: %s", url)
-        ret = requests.get(url, auth=auth, cookies=self.cookies)
-        if ret.status_code == 200:
-            self.logger.warning("Found existing package: %s", pkg)
+        # have we already uploaded these exact contents?
+        index = HashIndex(self.client.server)
+        if self.duplicate(index, pkg_path):
             return 0
 
-        # use curl for the file upload as it seems to work nicer than requests
-        # for this ridiculous workaround for file uploads.
-        curl_auth = "%s:%s" % auth
-        curl_url = server + "/dbfileupload"
-        command = ["curl", "-u", curl_auth, "-s", "-X", "POST", curl_url]
-        command += ["-b", c_cookie]
-        command += ["--header", "DESTINATION: 0"]
-        command += ["--header", "OBJECT_ID: -1"]
-        command += ["--header", "FILE_TYPE: 0"]
-        command += ["--header", "FILE_NAME: {}".format(pkg)]
-        command += ["--upload-file", pkg_path]
-        self.logger.debug("About to curl: %s", pkg)
-        # the next two logger calls would contain
-        # the name and password used so uncomment
-        # only if you have good control of the logs
-        # self.logger.debug("Auth: %s", curl_auth)
-        # self.logger.debug("command: %s", command)
+        # the test policy doesn't depend on the upload so fetch it while
+        # we check to see if the package already exists
+        catalog = get_catalog(self.client)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            policy = pool.submit(self.test_policy, title)
+            if self.exists(catalog, pkg):
+                # we won't need the policy, nor care if it's missing
+                policy.cancel()
+                self.logger.warning("Found existing package: %s", pkg)
+                return 0
+            # no point sending the package if we have nowhere to put it
+            root = policy.result()
+        self.logger.warning("Test policy found")
+
+        # stream the package up through our shared session, big ones go
+        # up in parts if the server can take them
+        self.logger.debug("About to upload: %s", pkg)
         self.logger.debug("pkg_path: %s", pkg_path)
-        ret = subprocess.check_output(command)
-        self.logger.debug("Done - ret: %s", ret)
-        packid = ET.fromstring(ret).findtext("id")
-        if packid == "":
-            raise ProcessorError("curl failed for url :{}".format(curl_url))
+        uploader = MultipartUploader(self.client, self.logger)
+        try:
+            packid = uploader.upload(pkg_path)
+        except UploadError as err:
+            raise ProcessorError(str(err))
         self.logger.debug("Uploaded and got ID: %s", packid)
+        catalog.add(pkg, packid)
+        if HASH_TYPE in uploader.hashes:
+            index.add(pkg_path, uploader.hashes[HASH_TYPE], packid, pkg)
 
         # build the package record XML
         today = datetime.datetime.now().strftime("(%Y-%m-%d)")
         data = "<package><id>{}</id>".format(packid)
         data += "<category>Applications</category>"
+        # the hash was worked out as we uploaded
+        data += uploader.hash_xml()
         data += "<notes>Built by Autopkg. {}</notes></package>".format(today)
 
-        # we use requests for all the other API calls as it codes nicer
+        # we use the shared client for all the other API calls
         # update the package details
         url = base + "packages/id/{}".format(packid)
-        # we set up some retries as sometimes the server
-        # takes a minute to settle with a new package upload
+        # the server sometimes takes a while to settle after a new
+        # package upload so we keep trying, quickly at first
         # (Can we have an API that allows for an upload and
         # setting this all in one go.)
-        count = 0
-        while True:
-            count += 1
-            self.logger.debug("package update attempt %s", count)
-            ret = requests.put(url, auth=auth, headers=hdrs,
-                               data=data, cookies=self.cookies)
-            if ret.status_code == 201:
-                break
-            self.logger.debug("Attempt failed with code: %s" % ret.status_code)
-            self.logger.debug("URL: %s" % url)
-            if count > 10:
-                raise ProcessorError(
-                    "Package update failed with code: %s" % ret.status_code
+        def attempt():
+            ret = self.client.put(url, data=data)
+            if ret.status_code != 201:
+                self.logger.debug(
+                    "Package update failed with code: %s", ret.status_code
                 )
-            sleep(20)
+            return ret
 
-        # now for the test policy update
-        policy_name = "TEST-{}".format(title)
-        url = base + "policies/name/{}".format(policy_name)
-        ret = requests.get(url, auth=auth, cookies=self.cookies)
-        if ret.status_code != 200:
+        deadline = float(self.env.get("ready_deadline") or READY_DEADLINE)
+        (ret, tries, seconds) = wait_until(
+            attempt, lambda ret: ret.status_code == 201, deadline
+        )
+        record("package", tries, seconds, ret.status_code == 201)
+        self.logger.info(
+            "Package update took %s tries in %.1f seconds", tries, seconds
+        )
+        if ret.status_code != 201:
             raise ProcessorError(
-                "Test Policy %s not found: %s" % (url, ret.status_code)
+                "Package update failed with code: %s : %s"
+                % (ret.status_code, url)
             )
-        self.logger.warning("Test policy found")
-        root = ET.fromstring(ret.text)
+
+        # now for the test policy update
         self.logger.debug("about to set package details")
         root.find("package_configuration/packages/package/id").text = str(
             packid
@@ -193,7 +242,7 @@ class JPCImporter(Processor):
         root.find("package_configuration/packages/package/name").text = pkg
         url = base + "policies/id/{}".format(root.findtext("general/id"))
         data = ET.tostring(root)
-        ret = requests.put(url, auth=auth, data=data, cookies=self.cookies)
+        ret = self.client.put(url, data=data)
         if ret.status_code != 201:
             raise ProcessorError(
                 "Test policy %s update failed: %s" % (url, ret.status_code)
@@ -203,6 +252,8 @@ class JPCImporter(Processor):
         self.logger.info("Done Package: %s Test Policy: %s", pkg, pol_id)
         return pol_id
 
+    @metrics.instrumented("jpc_importer_summary_result")
+    @profiled
     def main(self):
         """Do it!"""
         self.setup_logging()
@@ -0,0 +1,5 @@
+"""Shared code for the PatchBot processors
+
+AutoPkg loads each processor from its file so the processors put this
+directory on `sys.path` themselves before importing from here.
+"""
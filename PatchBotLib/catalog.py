@@ -0,0 +1,187 @@
+"""Catalog of the packages on the server
+
+One `packages` list download answers every "is this package already
+there?" question for the whole run instead of one `packages/name/...`
+request per package. Packages are also indexed by title and version
+using our `<title>-<version>.pkg` naming convention.
+
+The list is kept on disk for `CATALOG_TTL`. A package the saved copy
+doesn't know sends us back to the server for a fresh list, at most once
+per process. One it does know may have been deleted since so it is
+checked by name before we trust it.
+"""
+
+import re
+import time
+import threading
+
+from PatchBotLib.store import locked, load_json, save_json
+from PatchBotLib.client import parsed
+
+# how long a saved copy of the list is good for (seconds)
+CATALOG_TTL = 3600
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+class CatalogError(Exception):
+    """We couldn't get the package list"""
+
+
+def parse_name(name):
+    """(title, version) from a package name or None if it doesn't
+    follow the convention"""
+    if not name or not name.endswith(".pkg") or "-" not in name:
+        return None
+    title, version = name[:-4].split("-", 1)
+    return (title, version)
+
+
+def version_key(version):
+    """Sort key that puts "10.2" after "9.15" """
+    return [
+        (0, int(part)) if part.isdigit() else (1, part)
+        for part in re.split(r"[.\-_ ]+", version.lower())
+        if part
+    ]
+
+
+class Catalog:
+    """The packages on one server"""
+
+    FILE = "catalog.json"
+
+    def __init__(self, client):
+        self.client = client
+        self.packages = None  # name -> id
+        self.titles = {}  # title -> {version: (name, id)}
+        self.fresh = False  # downloaded by this process
+        self.checked = set()  # names from the saved copy we've checked
+        self.lock = threading.RLock()
+
+    def load(self):
+        """Use the saved copy if it isn't too old"""
+        with locked(self.FILE):
+            entry = load_json(self.FILE).get(self.client.server)
+        if entry and entry["fetched"] + CATALOG_TTL > time.time():
+            self.packages = entry["packages"]
+            self.index()
+            return True
+        return False
+
+    def refresh(self):
+        """Download the package list"""
+        url = self.client.base + "packages"
+        ret = self.client.get(url)
+        if ret.status_code != 200:
+            raise CatalogError(
+                "Package list download failed: {} : {}".format(
+                    ret.status_code, url
+                )
+            )
+        packages = {}
+        for package in parsed(ret).findall("package"):
+            packages[package.findtext("name")] = package.findtext("id")
+        self.packages = packages
+        self.fresh = True
+        self.index()
+        self.save()
+
+    def index(self):
+        """Rebuild the title and version index"""
+        self.titles = {}
+        for name, idn in self.packages.items():
+            self.index_one(name, idn)
+
+    def index_one(self, name, idn):
+        parsed = parse_name(name)
+        if parsed:
+            self.titles.setdefault(parsed[0], {})[parsed[1]] = (name, idn)
+
+    def save(self):
+        with locked(self.FILE):
+            data = load_json(self.FILE)
+            data[self.client.server] = {
+                "fetched": time.time(),
+                "packages": self.packages,
+            }
+            save_json(self.FILE, data)
+
+    def ensure(self):
+        """Make sure we have a list, from disk if we can"""
+        if self.packages is None and not self.load():
+            self.refresh()
+
+    def ready(self):
+        """Do we have a list without asking the server?"""
+        with self.lock:
+            return self.packages is not None or self.load()
+
+    def confirm(self, name):
+        """Is the package `name` from the saved copy still there? Its ID
+        as the server has it now if so"""
+        url = self.client.base + "packages/name/{}".format(name)
+        ret = self.client.get(url)
+        if ret.status_code == 200:
+            self.packages[name] = parsed(ret).findtext("id")
+            self.index_one(name, self.packages[name])
+            self.checked.add(name)
+            return True
+        if ret.status_code == 404:
+            return False
+        raise CatalogError(
+            "Package check failed: {} : {}".format(ret.status_code, url)
+        )
+
+    def find(self, name):
+        """ID of the package called `name` or None"""
+        with self.lock:
+            self.ensure()
+            if self.fresh or name in self.checked:
+                return self.packages.get(name)
+            if name in self.packages and self.confirm(name):
+                return self.packages[name]
+            # our saved copy is out of date
+            self.refresh()
+            return self.packages.get(name)
+
+    def add(self, name, idn):
+        """We've just created package `name`"""
+        with self.lock:
+            if self.packages is not None:
+                self.packages[name] = idn
+                self.index_one(name, idn)
+                self.save()
+
+    def versions(self, title):
+        """[(version, name, id)] of the packages for `title`, oldest
+        first"""
+        with self.lock:
+            self.ensure()
+            found = [
+                (version, name, idn)
+                for version, (name, idn) in self.titles.get(title, {}).items()
+            ]
+        return sorted(found, key=lambda item: version_key(item[0]))
+
+    def version(self, title, version):
+        """(name, id) of the package for `title` and `version` or None"""
+        with self.lock:
+            self.ensure()
+            return self.titles.get(title, {}).get(version)
+
+    def latest(self, title):
+        """(version, name, id) of the newest package for `title` or None"""
+        found = self.versions(title)
+        return found[-1] if found else None
+
+
+def get_catalog(client):
+    """The shared catalog for `client`'s server"""
+    with _catalogs_lock:
+        catalog = _catalogs.get(client.server)
+        if catalog is None:
+            catalog = Catalog(client)
+            _catalogs[client.server] = catalog
+        return catalog
@@ -0,0 +1,348 @@
+"""Shared HTTP client for the PatchBot processors
+
+Every processor used to call `requests.get` and `requests.put` directly
+which costs a fresh TCP and TLS handshake for every API call. Instead we
+keep one keep-alive `requests.Session` per Jamf server per process with
+auth, the load balancer sticky cookie and default headers attached once.
+AutoPkg runs all the recipes in a single `autopkg run` in one process so
+the pooled connections carry over from one recipe to the next.
+
+The sticky cookie and the bearer token are also kept in a `SessionStore`
+so that the next process can skip the handshake altogether.
+
+A client can be shared by several threads. Give it a `limiter`, such as
+a `TokenBucket`, and every request waits its turn. Every request also
+waits for the host wide `Governor` for the server so that parallel
+autopkg runs don't swamp it between them.
+
+Identical GETs made at the same time, typically the same title or policy
+list wanted by several batch workers, share one call and one response. A
+PUT to the URL stops later GETs joining a call made before it. Use
+`parsed()` to share the parsed document too.
+
+Every request is recorded with `PatchBotLib.metrics`, how long it took,
+how long it waited for the limits, the bytes each way and its retries.
+
+Where we only read a few sections of a Classic API object `get_subset()`
+asks for just those through the subset endpoint. The XML has the same
+layout as the whole object so callers don't need to care whether the
+server obliged.
+"""
+
+import calendar
+import threading
+import time
+import xml.etree.ElementTree as ET
+import requests
+from requests.adapters import HTTPAdapter
+
+from PatchBotLib.store import SessionStore
+from PatchBotLib.ratelimit import Governor
+from PatchBotLib import metrics
+
+# connection pool tuning. We only ever talk to one host but we want
+# enough connections in the pool for concurrent callers
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+
+# retries on connection errors only, status codes are for the caller
+CONNECT_RETRIES = 3
+
+# (connect, read) timeout in seconds
+TIMEOUT = (10, 120)
+
+# the two load balancer cookies. Ordinary Jamf Cloud uses APBALANCEID,
+# Premium Jamf Cloud uses AWSALB
+STICKY_COOKIES = ("APBALANCEID", "AWSALB")
+
+# Jamf Pro API endpoint that swaps basic auth for a bearer token. The
+# Classic API accepts the token too
+TOKEN_PATH = "/api/v1/auth/token"
+
+# the server is throttling us
+THROTTLED = (429, 503)
+
+# what a server that can't do a subset says
+SUBSETS_UNSUPPORTED = (400, 404)
+
+_clients = {}
+_clients_lock = threading.Lock()
+_parse_lock = threading.Lock()
+
+
+class Flight:
+    """A GET in progress that identical GETs can wait for"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.ret = None
+        self.error = None
+
+
+class JamfClient:
+    """A pooled, authenticated session to a single Jamf Pro server"""
+
+    def __init__(self, server, auth, limits=None):
+        self.server = server.rstrip("/")
+        self.base = self.server + "/JSSResource/"
+        self.auth = auth
+        self.limiter = None
+        self.governor = Governor(self.server, *(limits or ()))
+        self.lock = threading.Lock()
+        self.flights = {}  # (url, accept) -> Flight
+        self.flights_lock = threading.Lock()
+        self.coalesced = 0  # GETs that shared another's call
+        self.subsets = True  # until the server shows it doesn't do them
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=POOL_CONNECTIONS,
+            pool_maxsize=POOL_MAXSIZE,
+            max_retries=CONNECT_RETRIES,
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.auth = auth
+        # the API defaults to XML but we say so anyway. Calls that want
+        # JSON pass their own Accept header
+        self.session.headers.update({"Accept": "application/xml"})
+        self.store = SessionStore(self.server, auth[0])
+        self.cookie = self.store.get("cookie")
+        if self.cookie:
+            name, value = self.cookie.split("=", 1)
+            self.session.cookies.set(name, value)
+        else:
+            self.cookie = self.sticky_cookie()
+        self.token = self.store.get("token") or self.new_token()
+        self.use_token()
+
+    def sticky_cookie(self):
+        """Get the load balancer cookie so that we hit the same server
+        for every request. Returns the cookie as `name=value` or None"""
+        # the front page will give us the cookies, the session's cookie
+        # jar then hands them back on every call
+        ret = self.session.get(self.server, timeout=TIMEOUT)
+        return self.save_cookie(ret)
+
+    def save_cookie(self, ret):
+        """Store the sticky cookie if response `ret` set a new one"""
+        for cookie in ret.cookies:
+            if cookie.name in STICKY_COOKIES:
+                value = "{}={}".format(cookie.name, cookie.value)
+                # AWSALB is handed back on every response so only touch
+                # the store when it actually changes
+                if value != self.cookie:
+                    self.store.put("cookie", value, cookie.expires)
+                return value
+        return None
+
+    def new_token(self):
+        """Swap basic auth for a bearer token. Older servers don't have
+        the token endpoint so we return None and keep using basic auth"""
+        try:
+            ret = self.session.post(
+                self.server + TOKEN_PATH,
+                auth=self.auth,
+                headers={"Accept": "application/json"},
+                timeout=TIMEOUT,
+            )
+        except requests.RequestException:
+            return None
+        if ret.status_code != 200:
+            return None
+        try:
+            body = ret.json()
+            # "2020-12-22T04:18:48.123Z", we only need the seconds
+            expires = calendar.timegm(
+                time.strptime(body["expires"][:19], "%Y-%m-%dT%H:%M:%S")
+            )
+        except (ValueError, KeyError, TypeError):
+            return None
+        self.store.put("token", body["token"], expires)
+        return body["token"]
+
+    def use_token(self):
+        """Authenticate with the token if we have one, else basic auth"""
+        if self.token:
+            self.session.auth = None
+            self.session.headers["Authorization"] = "Bearer " + self.token
+        else:
+            self.session.auth = self.auth
+            self.session.headers.pop("Authorization", None)
+
+    def send(self, method, url, **kwargs):
+        """One request, once the limiter and the governor let us. Returns
+        the response and how long we waited for them"""
+        start = time.perf_counter()
+        if self.limiter:
+            self.limiter.take()
+        slot = self.governor.acquire()
+        wait = time.perf_counter() - start
+        try:
+            ret = self.session.request(method, url, **kwargs)
+        finally:
+            self.governor.release(slot)
+        if ret.status_code in THROTTLED:
+            self.governor.throttled(ret.headers.get("Retry-After"))
+        return (ret, wait)
+
+    def request(self, method, url, **kwargs):
+        """Make a request on the pooled session and record it"""
+        kwargs.setdefault("timeout", TIMEOUT)
+        start = time.perf_counter()
+        ret = None
+        waited = 0.0
+        retries = 0
+        try:
+            token = self.token
+            (ret, wait) = self.send(method, url, **kwargs)
+            waited += wait
+            if ret.status_code == 401 and token:
+                # our stored token has gone stale, get a fresh one and
+                # have one more go. Another thread may have beaten us
+                with self.lock:
+                    if self.token == token:
+                        self.store.drop("token")
+                        self.token = self.new_token()
+                        self.use_token()
+                # a streamed body has to start again from the top
+                body = kwargs.get("data")
+                if hasattr(body, "seek"):
+                    body.seek(0)
+                retries += 1
+                (ret, wait) = self.send(method, url, **kwargs)
+                waited += wait
+            if ret.status_code == 429 and rewind(kwargs.get("data")):
+                # the governor has paused everyone, one more go once
+                # it's over
+                retries += 1
+                (ret, wait) = self.send(method, url, **kwargs)
+                waited += wait
+        finally:
+            self.record(method, url, ret, kwargs, start, waited, retries)
+        # the load balancer hands out a new cookie if our server went away
+        cookie = self.save_cookie(ret)
+        if cookie:
+            self.cookie = cookie
+        return ret
+
+    def record(self, method, url, ret, kwargs, start, waited, retries):
+        """Record request `ret`, None if it never got an answer"""
+        status = received = None
+        if ret is not None:
+            status = ret.status_code
+            if kwargs.get("stream"):
+                # we haven't read it, the header will have to do
+                received = ret.headers.get("Content-Length")
+            else:
+                received = len(ret.content)
+        metrics.request(
+            method,
+            url,
+            status,
+            metrics.size(kwargs.get("data")),
+            int(received or 0),
+            time.perf_counter() - start,
+            waited,
+            retries,
+        )
+
+    def get(self, url, **kwargs):
+        """GET `url`. Identical GETs at the same time share one call"""
+        if set(kwargs) - {"headers"}:
+            # streams and anything unusual get their own call
+            return self.request("GET", url, **kwargs)
+        headers = kwargs.get("headers") or {}
+        accept = [v for k, v in headers.items() if k.lower() == "accept"]
+        key = (url, accept[0] if accept else None)
+        with self.flights_lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.ret
+        try:
+            flight.ret = self.request("GET", url, **kwargs)
+        except Exception as err:
+            flight.error = err
+            raise
+        finally:
+            self.land(key, flight)
+        return flight.ret
+
+    def get_subset(self, url, subsets, **kwargs):
+        """GET just the `subsets`, like ("General", "Scope"), of the
+        Classic API object at `url`, or the whole object if the server
+        can't do subsets"""
+        failed = None
+        if self.subsets:
+            subset = "{}/subset/{}".format(url, "&".join(subsets))
+            ret = self.get(subset, **kwargs)
+            if ret.status_code == 200:
+                return ret
+            failed = ret.status_code
+        ret = self.get(url, **kwargs)
+        if ret.status_code == 200 and failed in SUBSETS_UNSUPPORTED:
+            # the object is there so it was the subset that failed. A
+            # busy or broken server doesn't tell us that
+            self.subsets = False
+        return ret
+
+    def land(self, key, flight):
+        """`flight` is over, let the waiters have it"""
+        with self.flights_lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+        flight.done.set()
+
+    def put(self, url, data=None, **kwargs):
+        """PUT `data` to `url`, by default as XML"""
+        # GETs from now on mustn't get what was there before
+        with self.flights_lock:
+            for key in [key for key in self.flights if key[0] == url]:
+                del self.flights[key]
+        headers = {"Content-Type": "application/xml"}
+        headers.update(kwargs.pop("headers", None) or {})
+        return self.request("PUT", url, data=data, headers=headers, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        """POST `data` to `url`"""
+        return self.request("POST", url, data=data, **kwargs)
+
+
+def parsed(ret):
+    """The XML document in response `ret`, parsed only once however many
+    callers share the response. Copy it before changing it"""
+    with _parse_lock:
+        root = getattr(ret, "patchbot_root", None)
+        if root is None:
+            with metrics.timed("parse", metrics.endpoint(ret.url)):
+                root = ret.patchbot_root = ET.fromstring(ret.content)
+        return root
+
+
+def rewind(body):
+    """Can we send request body `body` again? Rewinds it if need be"""
+    if body is None or isinstance(body, (bytes, str, dict)):
+        return True
+    if hasattr(body, "seek"):
+        body.seek(0)
+        return True
+    return False
+
+
+def get_client(server, auth, limits=None):
+    """Return the shared client for `server`, building it on first use.
+    `limits` is (rate, inflight) for the governor"""
+    key = (server.rstrip("/"), auth[0])
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = JamfClient(server, auth, limits)
+            _clients[key] = client
+        return client
@@ -0,0 +1,155 @@
+"""Content hash index of the packages we've uploaded
+
+Maps the hash of a package to its Jamf package ID and name so that
+JPCImporter can skip uploading a package whose contents are already on
+the server, even under another name, without asking the server.
+
+Hashing a whole package just to look it up would mean reading it twice
+so entries are also keyed on a cheap sample, the size plus a hash of
+the first and last MB. Only a package whose sample matches needs its
+full hash, anything new is hashed as it uploads. The full hash of each
+package file is kept with its size and modification time so the same
+file built again isn't read again on every run.
+
+Entries are checked against the server again once they are older than
+`DEDUP_RECHECK` in case the package has been deleted.
+"""
+
+from os import path
+import os
+import time
+import hashlib
+
+from PatchBotLib.store import locked, load_json, save_json
+from PatchBotLib.upload import new_hashes, HASH_TYPE, CHUNK_SIZE
+
+# how long we trust an entry before checking the package is still there
+DEDUP_RECHECK = 24 * 3600
+
+# bytes from each end of the package that go into the sample
+SAMPLE_SIZE = 1024 * 1024
+
+
+def sample(pkg_path):
+    """Cheap fingerprint of the package at `pkg_path`"""
+    size = path.getsize(pkg_path)
+    digest = hashlib.sha512()
+    with open(pkg_path, "rb") as fp:
+        digest.update(fp.read(SAMPLE_SIZE))
+        if size > SAMPLE_SIZE:
+            fp.seek(max(SAMPLE_SIZE, size - SAMPLE_SIZE))
+            digest.update(fp.read(SAMPLE_SIZE))
+    return "{}:{}".format(size, digest.hexdigest())
+
+
+def file_stamp(pkg_path):
+    """[size, modification time] of `pkg_path`, it has changed if
+    either has"""
+    stat = os.stat(pkg_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def full_hash(pkg_path):
+    """`HASH_TYPE` hex digest of the package at `pkg_path`"""
+    digest = new_hashes()[HASH_TYPE]
+    with open(pkg_path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HashIndex:
+    """Package hashes for one server"""
+
+    FILE = "packages.json"
+
+    def __init__(self, server):
+        self.server = server
+
+    def _load(self):
+        return load_json(self.FILE).get(
+            self.server, {"hashes": {}, "samples": {}}
+        )
+
+    def digest(self, entry, pkg_path):
+        """The full hash of `pkg_path`, from `entry` if the file hasn't
+        changed since we last hashed it"""
+        stamp = file_stamp(pkg_path)
+        known = entry.get("files", {}).get(path.abspath(pkg_path))
+        if known and known["stamp"] == stamp:
+            return known["hash"]
+        value = "{}:{}".format(HASH_TYPE, full_hash(pkg_path))
+        self.remember(pkg_path, value, stamp)
+        return value
+
+    def remember(self, pkg_path, value, stamp):
+        """Keep the full hash `value` of `pkg_path` as it is at `stamp`"""
+        with locked(self.FILE):
+            data = load_json(self.FILE)
+            entry = data.setdefault(self.server, {"hashes": {}, "samples": {}})
+            files = entry.setdefault("files", {})
+            # forget packages that have gone
+            for name in [name for name in files if not path.exists(name)]:
+                del files[name]
+            files[path.abspath(pkg_path)] = {"stamp": stamp, "hash": value}
+            save_json(self.FILE, data)
+
+    def find(self, pkg_path):
+        """The entry, `{"id", "name", "checked"}`, for a package with the
+        same contents as `pkg_path` or None"""
+        key = sample(pkg_path)
+        with locked(self.FILE):
+            entry = self._load()
+        candidates = entry["samples"].get(key)
+        if not candidates:
+            return None
+        value = self.digest(entry, pkg_path)
+        if value not in candidates:
+            return None
+        found = entry["hashes"].get(value)
+        if found:
+            found["hash"] = value
+        return found
+
+    def stale(self, found):
+        """Is it time to check `found` with the server again?"""
+        return found["checked"] + DEDUP_RECHECK < time.time()
+
+    def add(self, pkg_path, digest, packid, name):
+        """Record the upload of `pkg_path` with `HASH_TYPE` hex `digest`"""
+        key = sample(pkg_path)
+        value = "{}:{}".format(HASH_TYPE, digest)
+        with locked(self.FILE):
+            data = load_json(self.FILE)
+            entry = data.setdefault(self.server, {"hashes": {}, "samples": {}})
+            entry["hashes"][value] = {
+                "id": packid,
+                "name": name,
+                "checked": time.time(),
+            }
+            samples = entry["samples"].setdefault(key, [])
+            if value not in samples:
+                samples.append(value)
+            save_json(self.FILE, data)
+        # the upload worked the hash out so the next run needn't
+        self.remember(pkg_path, value, file_stamp(pkg_path))
+
+    def checked(self, found):
+        """The server still has `found`"""
+        with locked(self.FILE):
+            data = load_json(self.FILE)
+            entry = data.get(self.server, {}).get("hashes", {})
+            if found["hash"] in entry:
+                entry[found["hash"]]["checked"] = time.time()
+                save_json(self.FILE, data)
+
+    def drop(self, found):
+        """The server no longer has `found`"""
+        with locked(self.FILE):
+            data = load_json(self.FILE)
+            entry = data.get(self.server, {"hashes": {}, "samples": {}})
+            entry["hashes"].pop(found["hash"], None)
+            for samples in entry["samples"].values():
+                if found["hash"] in samples:
+                    samples.remove(found["hash"])
+            save_json(self.FILE, data)
@@ -0,0 +1,185 @@
+"""One log file for every PatchBot processor
+
+Each processor used to set up its own `TimedRotatingFileHandler` and
+write to it as it went, so with many titles at once the formatting and
+the disk writes sat in the middle of the work and parallel autopkg runs
+raced each other to roll the files over.
+
+Now `get_logger()` gives a processor a logger that only puts records on
+a queue. One background listener per process formats them and writes
+them to `PatchBot.log` in `/usr/local/var/log`. The file is shared by
+every PatchBot process, each write and the daily rollover happen under a
+file lock so only one process rolls it over. Old files keep the date,
+like `PatchBot.log.2026-10-16`, and the last `LOG_BACKUPS` are kept.
+
+Formatting waits for the listener so pass the values as arguments,
+`logger.debug("About to get: %s", url)`, rather than building the
+message first. Wrap request and response bodies in `Payload` and only
+the first `LOG_PAYLOAD` characters are written, and only if the level is
+on.
+"""
+
+import os
+import copy
+import glob
+import fcntl
+import queue
+import atexit
+import datetime
+import logging
+import threading
+from os import path
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_DIR = "/usr/local/var/log"
+LOG_FILE = "PatchBot.log"
+
+# days of old log files kept
+LOG_BACKUPS = 7
+
+# longest request or response body written to the log (characters)
+LOG_PAYLOAD = 2000
+
+LOG_FORMAT = "%(asctime)s %(name)s %(levelname)s %(message)s"
+LOG_DATEFMT = "%Y-%m-%d %H:%M:%S"
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+class SharedFileHandler(logging.Handler):
+    """Appends to a log file shared by several processes, rolling it over
+    daily. Every write takes the file lock so only one process rolls it
+    over and the others follow it to the new file"""
+
+    def __init__(self, filename, backups=LOG_BACKUPS):
+        super().__init__()
+        self.filename = filename
+        self.backups = backups
+        self.stream = None
+        self.lockfile = open(filename + ".lock", "a")
+
+    def rollover(self):
+        """Move the file aside if it was last written before today"""
+        try:
+            written = os.stat(self.filename).st_mtime
+        except FileNotFoundError:
+            return
+        day = datetime.date.fromtimestamp(written)
+        if day >= datetime.date.today():
+            return
+        os.replace(self.filename, "{}.{}".format(self.filename, day))
+        for old in sorted(glob.glob(self.filename + ".????-??-??"))[
+            : -self.backups
+        ]:
+            os.unlink(old)
+
+    def current(self):
+        """The stream for the file as it is now, another process may have
+        rolled it over"""
+        if self.stream is not None:
+            try:
+                same = os.fstat(self.stream.fileno()).st_ino == os.stat(
+                    self.filename
+                ).st_ino
+            except FileNotFoundError:
+                same = False
+            if not same:
+                self.stream.close()
+                self.stream = None
+        if self.stream is None:
+            self.stream = open(self.filename, "a")
+        return self.stream
+
+    def emit(self, record):
+        try:
+            line = self.format(record) + "\n"
+            fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+            try:
+                self.rollover()
+                stream = self.current()
+                stream.write(line)
+                stream.flush()
+            finally:
+                fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        self.lockfile.close()
+        super().close()
+
+
+class LazyQueueHandler(QueueHandler):
+    """Puts records on the queue as they are, the listener formats them.
+    A traceback has to be turned into text here while we have it, and
+    a dictionary or list is copied in case it changes before then"""
+
+    MUTABLE = (dict, list, set)
+
+    def prepare(self, record):
+        if isinstance(record.args, tuple):
+            record.args = tuple(
+                copy.deepcopy(arg) if isinstance(arg, self.MUTABLE) else arg
+                for arg in record.args
+            )
+        elif isinstance(record.args, dict):
+            # a lone dictionary argument ends up as the args themselves
+            record.args = copy.deepcopy(record.args)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info
+            )
+            record.exc_info = None
+        return record
+
+
+class Payload:
+    """A request or response `body` for the log, cut to `limit`
+    characters. Nothing is decoded unless the record is written"""
+
+    def __init__(self, body, limit=LOG_PAYLOAD):
+        self.body = body
+        self.limit = limit
+
+    def __str__(self):
+        body = self.body
+        if isinstance(body, bytes):
+            body = body[: self.limit * 4].decode("utf-8", "replace")
+            size = len(self.body)
+        else:
+            body = str(body)
+            size = len(body)
+        if len(body) <= self.limit:
+            return body
+        return "{}... ({} in all)".format(body[: self.limit], size)
+
+
+def log_queue():
+    """The queue every logger feeds, starting its listener on first use"""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            handler = SharedFileHandler(path.join(LOG_DIR, LOG_FILE))
+            handler.setFormatter(
+                logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT)
+            )
+            _queue = queue.SimpleQueue()
+            listener = QueueListener(_queue, handler)
+            listener.start()
+            # write out whatever is still queued when autopkg finishes
+            atexit.register(listener.stop)
+        return _queue
+
+
+def get_logger(name, level=logging.DEBUG):
+    """The logger `name` writing to the shared log file. One that already
+    has a handler is left as it is"""
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    if not logger.handlers:
+        logger.addHandler(LazyQueueHandler(log_queue()))
+    return logger
@@ -0,0 +1,366 @@
+"""Where the time goes
+
+The log files say what happened but not how long it took, so a slow
+night could be the upload, waiting for the server to settle or slow
+PUTs and there was no telling which. Now the client records every API
+request, its endpoint, method, status, bytes each way, how long it took,
+how long it waited for the rate limits and how many retries it needed.
+The parse paths and the long phases, the upload and the settle wait,
+are timed too.
+
+A processor's `main()` wrapped in `instrumented()` collects what its run
+recorded and when it's done
+
+ - appends the records as JSON lines to `PatchBot-requests.jsonl`
+ - writes the totals for the run to `patchbot_<processor>.prom` for the
+   Prometheus node exporter's textfile collector
+ - adds a rollup to the processor's summary result and logs it
+
+Both files go next to the log files in `/usr/local/var/log` unless
+`PATCHBOT_METRICS_DIR` says otherwise, point it at the textfile
+collector's directory if you run one.
+"""
+
+import os
+import re
+import json
+import time
+import fcntl
+import logging
+import tempfile
+import functools
+import threading
+from os import path
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+METRICS_DIR = os.environ.get("PATCHBOT_METRICS_DIR", "/usr/local/var/log")
+REQUESTS_FILE = "PatchBot-requests.jsonl"
+PROM_FILE = "patchbot_%s.prom"
+
+# start the JSON lines file afresh past this size, keeping one old copy
+REQUESTS_MAX = 50 * 1024 * 1024
+
+# the rollup fields added to the summary result
+ROLLUP_FIELDS = ("api_requests", "api_retries", "api_seconds", "api_bytes")
+
+
+class Recorder:
+    """Everything recorded in this process, shared by all threads"""
+
+    def __init__(self):
+        self.records = []
+        self.runs = 0
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def start(self):
+        """A run is starting, returns where its records begin"""
+        with self.lock:
+            self.runs += 1
+            return len(self.records)
+
+    def finish(self, mark):
+        """The run that started at `mark` is over, returns its records"""
+        with self.lock:
+            records = self.records[mark:]
+            self.runs -= 1
+            if not self.runs:
+                # nobody needs them any more
+                self.records = []
+            return records
+
+
+RECORDER = Recorder()
+
+
+def endpoint(url):
+    """The path of `url` without IDs and names so that calls for the
+    same kind of object add up"""
+    return re.sub(r"/(id|name)/[^/]+", r"/\1/{\1}", urlsplit(url).path)
+
+
+def size(body):
+    """Bytes in request body `body` if we can tell without reading it"""
+    if body is None or isinstance(body, dict):
+        return 0
+    if isinstance(body, str):
+        return len(body.encode())
+    try:
+        return len(body)
+    except TypeError:
+        return 0
+
+
+def request(method, url, status, sent, received, seconds, wait, retries):
+    """Record one API request. `status` is None if it never got an
+    answer, `wait` is the time spent waiting for the rate limits"""
+    RECORDER.add(
+        {
+            "kind": "request",
+            "time": time.time(),
+            "method": method,
+            "endpoint": endpoint(url),
+            "status": status,
+            "bytes_out": sent,
+            "bytes_in": received,
+            "seconds": round(seconds, 4),
+            "wait": round(wait, 4),
+            "retries": retries,
+        }
+    )
+
+
+def event(kind, name, seconds, **fields):
+    """Record `seconds` spent on `name`, like a parse or the upload"""
+    record = {
+        "kind": kind,
+        "time": time.time(),
+        "name": name,
+        "seconds": round(seconds, 4),
+    }
+    record.update(fields)
+    RECORDER.add(record)
+
+
+@contextmanager
+def timed(kind, name, **fields):
+    """Record the time spent in the block as event `kind`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        event(kind, name, time.perf_counter() - start, **fields)
+
+
+def rollup(records):
+    """Totals for `records`"""
+    requests = [r for r in records if r["kind"] == "request"]
+    total = {
+        "requests": len(requests),
+        "errors": sum(
+            1 for r in requests if r["status"] is None or r["status"] >= 400
+        ),
+        "retries": sum(r["retries"] for r in requests),
+        "bytes_out": sum(r["bytes_out"] for r in requests),
+        "bytes_in": sum(r["bytes_in"] for r in requests),
+        "seconds": sum(r["seconds"] for r in requests),
+        "wait": sum(r["wait"] for r in requests),
+        "slowest": None,
+        "phases": {},
+    }
+    if requests:
+        slowest = max(requests, key=lambda r: r["seconds"])
+        total["slowest"] = "{} {} {:.2f}s".format(
+            slowest["method"], slowest["endpoint"], slowest["seconds"]
+        )
+    for record in records:
+        if record["kind"] != "request":
+            phases = total["phases"]
+            phases[record["kind"]] = (
+                phases.get(record["kind"], 0) + record["seconds"]
+            )
+    return total
+
+
+def label(value):
+    """`value` escaped for a Prometheus label"""
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+def prometheus(processor, records, seconds, ok):
+    """The textfile collector file for one run of `processor`"""
+    by_call = {}
+    parses = {}
+    for record in records:
+        if record["kind"] == "request":
+            key = (
+                record["method"], record["endpoint"], record["status"] or 0
+            )
+            call = by_call.setdefault(key, [0, 0.0, 0.0])
+            call[0] += 1
+            call[1] += record["seconds"]
+            call[2] = max(call[2], record["seconds"])
+        elif record["kind"] == "parse":
+            parses[record["name"]] = (
+                parses.get(record["name"], 0) + record["seconds"]
+            )
+    total = rollup(records)
+    lines = []
+
+    def metric(name, text, values):
+        lines.append("# HELP patchbot_{} {}".format(name, text))
+        lines.append("# TYPE patchbot_{} gauge".format(name))
+        for labels, value in values:
+            labels = dict(processor=processor, **labels)
+            lines.append(
+                "patchbot_{}{{{}}} {}".format(
+                    name,
+                    ",".join(
+                        '{}="{}"'.format(k, label(v))
+                        for k, v in labels.items()
+                    ),
+                    round(value, 4),
+                )
+            )
+
+    calls = [
+        ({"method": m, "endpoint": e, "status": s}, values)
+        for ((m, e, s), values) in sorted(by_call.items())
+    ]
+    metric(
+        "requests",
+        "API requests in the last run",
+        [(labels, values[0]) for (labels, values) in calls],
+    )
+    metric(
+        "request_seconds",
+        "Time spent on API requests in the last run",
+        [(labels, values[1]) for (labels, values) in calls],
+    )
+    metric(
+        "request_seconds_max",
+        "Slowest API request in the last run",
+        [(labels, values[2]) for (labels, values) in calls],
+    )
+    metric(
+        "request_bytes",
+        "Bytes sent and received in the last run",
+        [
+            ({"direction": "out"}, total["bytes_out"]),
+            ({"direction": "in"}, total["bytes_in"]),
+        ],
+    )
+    metric("retries", "API retries in the last run", [({}, total["retries"])])
+    metric(
+        "rate_limit_wait_seconds",
+        "Time spent waiting for the rate limits in the last run",
+        [({}, total["wait"])],
+    )
+    metric(
+        "parse_seconds",
+        "Time spent parsing responses in the last run",
+        [({"endpoint": e}, s) for (e, s) in sorted(parses.items())],
+    )
+    metric(
+        "phase_seconds",
+        "Time spent on each phase in the last run",
+        [({"phase": p}, s) for (p, s) in sorted(total["phases"].items())],
+    )
+    metric("run_seconds", "How long the last run took", [({}, seconds)])
+    metric("run_ok", "Whether the last run worked", [({}, int(ok))])
+    metric(
+        "run_timestamp_seconds", "When the last run ended", [({}, time.time())]
+    )
+    return "\n".join(lines) + "\n"
+
+
+def save_requests(records):
+    """Append `records` to the JSON lines file"""
+    name = path.join(METRICS_DIR, REQUESTS_FILE)
+    if path.exists(name) and path.getsize(name) > REQUESTS_MAX:
+        os.replace(name, name + ".1")
+    with open(name, "a") as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            fp.write("".join(json.dumps(r) + "\n" for r in records))
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+def save_prometheus(processor, text):
+    """Atomically replace the textfile for `processor`, the collector
+    mustn't see half a file"""
+    fd, tmp = tempfile.mkstemp(dir=METRICS_DIR, prefix=".patchbot")
+    try:
+        with os.fdopen(fd, "w") as fp:
+            fp.write(text)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path.join(METRICS_DIR, PROM_FILE % processor.lower()))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class Run:
+    """What one processor run recorded"""
+
+    def __init__(self, processor):
+        self.processor = processor
+        self.start = time.perf_counter()
+        self.mark = RECORDER.start()
+
+    def finish(self, summary=None, ok=True):
+        """Export the run's records and add the rollup to `summary`, the
+        processor's summary result if it has one"""
+        seconds = time.perf_counter() - self.start
+        records = RECORDER.finish(self.mark)
+        for record in records:
+            record["processor"] = self.processor
+        total = rollup(records)
+        logger = logging.getLogger(self.processor)
+        logger.info(
+            "API: %s requests, %s errors, %s retries, %.2fs, %.2fs waiting, "
+            "%s bytes out, %s bytes in, slowest %s, phases %s",
+            total["requests"],
+            total["errors"],
+            total["retries"],
+            total["seconds"],
+            total["wait"],
+            total["bytes_out"],
+            total["bytes_in"],
+            total["slowest"],
+            {k: round(v, 2) for (k, v) in total["phases"].items()},
+        )
+        if summary:
+            summary["data"].update(
+                {
+                    "api_requests": str(total["requests"]),
+                    "api_retries": str(total["retries"]),
+                    "api_seconds": "{:.2f}".format(total["seconds"]),
+                    "api_bytes": str(total["bytes_out"] + total["bytes_in"]),
+                }
+            )
+            summary["report_fields"] += [
+                f for f in ROLLUP_FIELDS if f not in summary["report_fields"]
+            ]
+        try:
+            if records:
+                save_requests(records)
+            save_prometheus(
+                self.processor,
+                prometheus(self.processor, records, seconds, ok),
+            )
+        except OSError as err:
+            # metrics are never worth failing a run for
+            logger.warning("Can't save metrics: %s", err)
+        return total
+
+
+def instrumented(summary):
+    """Decorate a processor's `main()` to record its run, `summary` is
+    the name of its summary result"""
+
+    def decorate(main):
+        @functools.wraps(main)
+        def run(self):
+            current = Run(type(self).__name__)
+            ok = False
+            try:
+                result = main(self)
+                ok = True
+                return result
+            finally:
+                current.finish(self.env.get(summary), ok)
+
+        return run
+
+    return decorate
@@ -0,0 +1,103 @@
+"""Find our version in a patch software title
+
+Shared by PatchManager and Production, both of which need the one
+`versions/version` record for the package they are working on.
+
+We used to take the first record whose `software_version` contained our
+version as a substring so "1.2" happily matched "11.2.3". Now we work
+out the keys for our version once and compare each record's keys with
+them, in this order of preference:
+
+ 1. exact, the `software_version` is our version
+ 2. normalized, equal after dropping case, separators and trailing
+    zeros so "81" matches "81.0.0" but not "81.0.1"
+ 3. leading, the first word of the `software_version` normalizes to our
+    version so "5.2" matches "5.2 (1234)"
+
+An exact match stops the search, otherwise the first record found at
+the best level wins.
+"""
+
+import re
+import xml.etree.ElementTree as ET
+
+from PatchBotLib.xmlstream import iter_records, drain
+from PatchBotLib import metrics
+
+EXACT, NORMALIZED, LEADING = range(3)
+
+
+def normalize(version):
+    """Comparison key for `version`. Numeric parts compare as numbers
+    and trailing zero parts are dropped"""
+    parts = [
+        int(part) if part.isdigit() else part
+        for part in re.split(r"[.\-_ ]+", version.strip().lower())
+        if part
+    ]
+    while parts and parts[-1] == 0:
+        parts.pop()
+    return tuple(parts)
+
+
+def leading(version):
+    """Comparison key for the first word of `version`"""
+    return normalize(re.split(r"[\s(]", version.strip(), 1)[0])
+
+
+def match_level(software_version, version, key):
+    """How well `software_version` matches `version`, one of EXACT,
+    NORMALIZED or LEADING, or None. `key` is `normalize(version)`"""
+    if software_version == version:
+        return EXACT
+    if normalize(software_version) == key:
+        return NORMALIZED
+    if leading(software_version) == key:
+        return LEADING
+    return None
+
+
+def find_version(ret, version):
+    """Stream the patch software title in response `ret` and return the
+    `version` record best matching `version`, or None"""
+    key = normalize(version)
+    best = None
+    best_level = None
+    with metrics.timed("parse", metrics.endpoint(ret.url)):
+        for record in iter_records(ret, "version", "versions"):
+            software_version = record.findtext("software_version") or ""
+            level = match_level(software_version, version, key)
+            if level is None:
+                continue
+            if best_level is None or level < best_level:
+                best, best_level = record, level
+            if level == EXACT:
+                break
+        drain(ret)
+    return best
+
+
+def set_package(record, idn, name):
+    """Point the version `record` at package `idn` called `name`. We
+    change any package already there rather than add another. Returns
+    False if it already pointed at our package"""
+    package = record.find("package")
+    if package is None:
+        package = ET.SubElement(record, "package")
+    changed = False
+    for tag, value in (("id", idn), ("name", name)):
+        element = package.find(tag)
+        if element is None:
+            element = ET.SubElement(package, tag)
+        if element.text != value:
+            element.text = value
+            changed = True
+    return changed
+
+
+def title_document(record):
+    """A patch software title document holding just `record`. Jamf only
+    updates the versions we send so this is all we need to PUT back"""
+    root = ET.Element("patch_software_title")
+    ET.SubElement(root, "versions").append(record)
+    return root
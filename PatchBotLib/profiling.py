@@ -0,0 +1,279 @@
+"""Where the CPU and memory go
+
+The metrics say how long the API calls took but not what the rest of a
+run was doing. Set `profile` in the recipe or `PATCHBOT_PROFILE=1` in
+the environment and a processor's `main()` wrapped in `profiled()` runs
+under cProfile and tracemalloc. Worker threads are profiled too. From
+Python 3.12 one profiler sees every thread, before that each thread the
+run starts gets its own. Daemon threads, like the log listener, outlive
+the run so they are left alone there. A profile that can't be taken or
+saved is logged and the run carries on without it.
+
+Each run leaves two files next to the log files in `/usr/local/var/log`,
+`<processor>-<time>-<pid>.prof` with the raw profile for `pstats` or
+snakeviz and a `.txt` report with
+
+ - the time spent in each phase, network, rate limits, parse and so on
+ - the functions with the most cumulative time
+ - the allocation sites holding the most memory near the peak
+
+The phase times overlap, the settle wait includes its network calls,
+and add up across threads so in batch mode they can be more than the
+run took.
+"""
+
+import os
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import datetime
+import functools
+import threading
+import tracemalloc
+from os import path
+
+PROFILE_DIR = os.environ.get("PATCHBOT_PROFILE_DIR", "/usr/local/var/log")
+
+# how many functions and allocation sites go in the report
+PROFILE_TOP = 25
+
+# how often we look for a new memory peak (seconds)
+PROFILE_SAMPLE = 0.25
+
+# frames kept for each allocation
+PROFILE_FRAMES = 5
+
+# before 3.12 cProfile only sees the thread that turned it on, from then
+# on it sees them all and only one can be on at a time
+PER_THREAD = sys.version_info < (3, 12)
+
+# the phases and the functions that make them up, "file:function"
+PHASES = (
+    ("network", ("requests/sessions.py:request", "urllib3/response.py:read")),
+    ("rate limits", ("ratelimit.py:take", "ratelimit.py:acquire")),
+    ("upload", ("PatchBotLib/upload.py:upload",)),
+    ("settle", ("PatchBotLib/ready.py:wait_until",)),
+    (
+        "parse",
+        (
+            "ElementTree.py:XML",
+            "ElementTree.py:feed",
+            "ElementTree.py:iterparse",
+            "json/decoder.py:decode",
+        ),
+    ),
+    ("serialize", ("ElementTree.py:tostring", "json/encoder.py:encode")),
+    ("cache files", ("store.py:load_json", "store.py:save_json")),
+)
+
+
+def wanted(value):
+    """Does the recipe input or environment variable `value` say yes?"""
+    return str(value or "").strip().lower() not in ("", "0", "false", "no")
+
+
+class Profile:
+    """cProfile for every thread and tracemalloc for one run"""
+
+    def __init__(self):
+        self.profiles = []
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.snapshot = None
+        self.peak = 0
+        self.tracing = False
+
+    def thread(self, *args):
+        """Profile function for new threads, swaps itself for cProfile.
+        A daemon thread would keep its profiler after the run and only
+        the thread itself can turn it off"""
+        sys.setprofile(None)
+        if not threading.current_thread().daemon:
+            self.enable()
+
+    def enable(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        with self.lock:
+            self.profiles.append(profile)
+
+    def sample(self):
+        """Keep a snapshot from near the memory peak"""
+        while not self.done.wait(PROFILE_SAMPLE):
+            (current, _) = tracemalloc.get_traced_memory()
+            if current > self.peak:
+                self.peak = current
+                self.snapshot = tracemalloc.take_snapshot()
+
+    def start(self):
+        # first as it fails if another profiler is on, nothing to undo
+        self.enable()
+        if PER_THREAD:
+            threading.setprofile(self.thread)
+        # somebody else may be tracing already, the scale test does
+        self.tracing = not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start(PROFILE_FRAMES)
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+        self.start_time = time.perf_counter()
+
+    def stop(self):
+        """Turn it all off, returns the combined stats or None if there
+        weren't any"""
+        self.seconds = time.perf_counter() - self.start_time
+        if PER_THREAD:
+            threading.setprofile(None)
+        # from 3.12 this turns ours off in every thread, before that
+        # only in this one but the workers have finished with theirs
+        with self.lock:
+            profiles = list(self.profiles)
+        for profile in profiles:
+            profile.disable()
+        self.done.set()
+        self.sampler.join()
+        (current, peak) = tracemalloc.get_traced_memory()
+        if self.snapshot is None or current >= self.peak:
+            self.snapshot = tracemalloc.take_snapshot()
+        self.peak = max(self.peak, peak)
+        if self.tracing:
+            tracemalloc.stop()
+        stats = None
+        for profile in profiles:
+            # pstats won't take a profile that saw nothing
+            profile.create_stats()
+            if not profile.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        return stats
+
+
+def phases(stats):
+    """Cumulative seconds for each of the PHASES in `stats`. A call only
+    counts if its caller is outside the phase so nothing counts twice"""
+
+    def name(func):
+        return "{}:{}".format(func[0], func[2])
+
+    found = {}
+    for phase, patterns in PHASES:
+
+        def inside(func):
+            label = name(func)
+            return any(label.endswith(p) for p in patterns)
+
+        total = 0.0
+        for func, (_, _, _, cumulative, callers) in stats.stats.items():
+            if not inside(func):
+                continue
+            if not callers:
+                total += cumulative
+                continue
+            for caller, calls in callers.items():
+                if not inside(caller):
+                    total += calls[3]
+        found[phase] = total
+    return found
+
+
+def allocations(snapshot):
+    """The top allocation sites in `snapshot`, ours left out"""
+    snapshot = snapshot.filter_traces(
+        (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        )
+    )
+    return snapshot.statistics("lineno")[:PROFILE_TOP]
+
+
+def report(processor, profile, by_phase):
+    """The text report for one run, the pstats listing goes after it"""
+    lines = [
+        "{} run at {:%Y-%m-%d %H:%M:%S}, {:.2f}s, peak memory {:.1f} MB"
+        .format(
+            processor,
+            datetime.datetime.now(),
+            profile.seconds,
+            profile.peak / 1e6,
+        ),
+        "",
+        "Time by phase (cumulative seconds)",
+    ]
+    for phase, seconds in by_phase.items():
+        lines.append("  {:<12} {:>9.3f}".format(phase, seconds))
+    lines += ["", "Top allocation sites near the peak"]
+    for stat in allocations(profile.snapshot):
+        frame = stat.traceback[0]
+        lines.append(
+            "  {:>10.1f} KB {:>8} blocks  {}:{}".format(
+                stat.size / 1024, stat.count, frame.filename, frame.lineno
+            )
+        )
+    lines += ["", "Top functions by cumulative time", ""]
+    return "\n".join(lines) + "\n"
+
+
+def save(processor, profile, stats):
+    """Write the profile and the report, returns the report's path"""
+    base = path.join(
+        PROFILE_DIR,
+        "{}-{:%Y%m%d-%H%M%S}-{}".format(
+            processor, datetime.datetime.now(), os.getpid()
+        ),
+    )
+    stats.dump_stats(base + ".prof")
+    by_phase = phases(stats)
+    with open(base + ".txt", "w") as fp:
+        fp.write(report(processor, profile, by_phase))
+        stats.stream = fp
+        stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+    logger = logging.getLogger(processor)
+    logger.info(
+        "Profile: %.2fs, peak memory %.1f MB, phases %s",
+        profile.seconds,
+        profile.peak / 1e6,
+        {k: round(v, 2) for (k, v) in by_phase.items() if v},
+    )
+    return base + ".txt"
+
+
+def profiled(main):
+    """Decorate a processor's `main()` to profile it when the recipe's
+    `profile` input or `PATCHBOT_PROFILE` asks for it"""
+
+    @functools.wraps(main)
+    def run(self):
+        if not wanted(
+            self.env.get("profile") or os.environ.get("PATCHBOT_PROFILE")
+        ):
+            return main(self)
+        processor = type(self).__name__
+        logger = logging.getLogger(processor)
+        profile = Profile()
+        try:
+            profile.start()
+        except Exception as err:
+            # another profiler is on, run without ours
+            logger.warning("Can't profile: %s", err)
+            return main(self)
+        try:
+            return main(self)
+        finally:
+            # never worth failing a run for
+            try:
+                stats = profile.stop()
+                if stats is None:
+                    logger.warning("Nothing to profile")
+                else:
+                    written = save(processor, profile, stats)
+                    logger.info("Profile written to %s", written)
+            except Exception as err:
+                logger.warning("Can't save profile: %s", err)
+
+    return run
@@ -0,0 +1,202 @@
+"""Keep our request rate down
+
+Jamf Cloud throttles clients that send too many requests at once. When
+several titles are worked on at the same time they share one client and
+so one `TokenBucket`, which lets through `rate` requests a second on
+average with bursts of up to `burst`.
+
+Several autopkg runs on the one build host don't know about each other
+so every request also goes through the `Governor` for its server. It
+keeps a token bucket and a list of the requests in flight in a locked
+store that every PatchBot process shares. The limits can be set with
+`PATCHBOT_RATE` and `PATCHBOT_INFLIGHT` in the AutoPkg preferences. A
+429 or 503 from the server pauses everyone on the host.
+
+    python3 -m PatchBotLib.ratelimit
+
+prints how busy each server is.
+"""
+
+import os
+import json
+import time
+import itertools
+import threading
+
+from PatchBotLib.store import locked, load_json, save_json
+
+# default requests a second and burst size
+RATE = 5
+BURST = 10
+
+# default host wide requests a second and requests in flight per server
+GOVERNOR_RATE = 10
+GOVERNOR_INFLIGHT = 8
+
+# how often we look again while waiting for a slot (seconds)
+GOVERNOR_POLL = 0.05
+
+# forget a request in flight this long even if its process is alive
+SLOT_TTL = 3600
+
+# how long to stop when the server throttles us without a Retry-After
+THROTTLE_PAUSE = 5
+
+
+class TokenBucket:
+    """A thread safe token bucket"""
+
+    def __init__(self, rate=RATE, burst=BURST):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Wait for a token"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.stamp) * self.rate
+                )
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Governor:
+    """The host wide limit for one Jamf server, shared by every PatchBot
+    process through a locked store. At most `rate` requests a second on
+    average and at most `inflight` at once. Bursts are `rate` requests,
+    or one below a request a second"""
+
+    FILE = "governor.json"
+
+    def __init__(
+        self, server, rate=GOVERNOR_RATE, inflight=GOVERNOR_INFLIGHT
+    ):
+        self.server = server
+        self.rate = float(rate)
+        self.burst = max(1.0, self.rate)
+        self.inflight = int(inflight)
+        self.count = itertools.count()
+
+    def _state(self, data, now):
+        """Our server's entry in `data` brought up to `now`"""
+        state = data.setdefault(
+            self.server,
+            {"tokens": self.burst, "stamp": now, "slots": {}, "pause": 0},
+        )
+        # the latest settings win
+        state["rate"] = self.rate
+        state["inflight"] = self.inflight
+        state["tokens"] = min(
+            self.burst, state["tokens"] + (now - state["stamp"]) * self.rate
+        )
+        state["stamp"] = now
+        for slot, started in list(state["slots"].items()):
+            pid = int(slot.split(":")[0])
+            if not alive(pid) or started + SLOT_TTL < now:
+                del state["slots"][slot]
+        return state
+
+    def acquire(self):
+        """Wait for our turn and return the slot to hand to release()"""
+        slot = "{}:{}".format(os.getpid(), next(self.count))
+        while True:
+            with locked(self.FILE):
+                data = load_json(self.FILE)
+                now = time.time()
+                state = self._state(data, now)
+                if (
+                    state["pause"] <= now
+                    and state["tokens"] >= 1
+                    and len(state["slots"]) < self.inflight
+                ):
+                    state["tokens"] -= 1
+                    state["slots"][slot] = now
+                    save_json(self.FILE, data)
+                    return slot
+                # nothing to save, the next look works it all out again
+                if state["pause"] > now:
+                    wait = state["pause"] - now
+                elif state["tokens"] < 1:
+                    wait = (1 - state["tokens"]) / self.rate
+                else:
+                    wait = GOVERNOR_POLL
+            time.sleep(min(wait, GOVERNOR_POLL * 10))
+
+    def release(self, slot):
+        """The request holding `slot` has finished"""
+        with locked(self.FILE):
+            data = load_json(self.FILE)
+            self._state(data, time.time())["slots"].pop(slot, None)
+            save_json(self.FILE, data)
+
+    def throttled(self, retry_after=None):
+        """The server told us to slow down, stop everyone for a while"""
+        try:
+            pause = float(retry_after)
+        except (TypeError, ValueError):
+            pause = THROTTLE_PAUSE
+        with locked(self.FILE):
+            data = load_json(self.FILE)
+            now = time.time()
+            state = self._state(data, now)
+            state["pause"] = max(state["pause"], now + pause)
+            state["tokens"] = 0
+            save_json(self.FILE, data)
+
+
+def alive(pid):
+    """Is process `pid` still running?"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def utilisation():
+    """How busy every server is, {server: {"rate", "tokens", "inflight",
+    "max_inflight", "paused"}}"""
+    with locked(Governor.FILE):
+        data = load_json(Governor.FILE)
+    now = time.time()
+    found = {}
+    for server, state in data.items():
+        governor = Governor(server, state["rate"], state["inflight"])
+        state = governor._state({server: state}, now)
+        found[server] = {
+            "rate": state["rate"],
+            "tokens": round(state["tokens"], 2),
+            "inflight": len(state["slots"]),
+            "max_inflight": state["inflight"],
+            "paused": round(max(0, state["pause"] - now), 2),
+        }
+    return found
+
+
+def limits(prefs):
+    """(rate, inflight) for the governor from the AutoPkg preferences.
+    Raises ValueError if either isn't a number more than zero"""
+    rate = float(prefs.get("PATCHBOT_RATE", GOVERNOR_RATE))
+    inflight = int(prefs.get("PATCHBOT_INFLIGHT", GOVERNOR_INFLIGHT))
+    if rate <= 0:
+        raise ValueError("PATCHBOT_RATE must be more than 0: %s" % rate)
+    if inflight <= 0:
+        raise ValueError(
+            "PATCHBOT_INFLIGHT must be more than 0: %s" % inflight
+        )
+    return (rate, inflight)
+
+
+if __name__ == "__main__":
+    print(json.dumps(utilisation(), indent=2))
@@ -0,0 +1,61 @@
+"""Wait for the server to settle
+
+After a package upload the server can take a while before it will take
+an update to the package record. We used to try every 20 seconds which
+wasted 20 seconds in the common case where it's ready almost at once.
+Instead we start with a short wait and back off exponentially with some
+jitter so parallel runs don't all retry together, up to a deadline.
+
+Every wait is recorded in `settle.jsonl` in the cache directory so the
+numbers here can be tuned from what the server actually does.
+"""
+
+import json
+import time
+import random
+
+from PatchBotLib.store import cache_path
+from PatchBotLib import metrics
+
+# first wait, growth factor and longest single wait (seconds)
+READY_FIRST = 0.5
+READY_FACTOR = 2
+READY_MAX = 20
+
+# give up after this long (seconds)
+READY_DEADLINE = 240
+
+SETTLE_FILE = "settle.jsonl"
+
+
+def wait_until(attempt, ready, deadline=READY_DEADLINE):
+    """Call `attempt()` until `ready(result)` is true or `deadline`
+    seconds have passed. Returns (result, tries, seconds) where result
+    is the last one, ready or not"""
+    start = time.monotonic()
+    delay = READY_FIRST
+    tries = 0
+    while True:
+        tries += 1
+        result = attempt()
+        elapsed = time.monotonic() - start
+        if ready(result) or elapsed >= deadline:
+            return (result, tries, elapsed)
+        # equal jitter, between half and all of the current delay
+        pause = delay / 2 + random.uniform(0, delay / 2)
+        time.sleep(min(pause, deadline - elapsed))
+        delay = min(delay * READY_FACTOR, READY_MAX)
+
+
+def record(what, tries, seconds, ok):
+    """Note how long `what` took to settle"""
+    line = {
+        "time": time.time(),
+        "what": what,
+        "tries": tries,
+        "seconds": round(seconds, 3),
+        "ok": ok,
+    }
+    with open(cache_path(SETTLE_FILE), "a") as fp:
+        fp.write(json.dumps(line) + "\n")
+    metrics.event("settle", what, seconds, tries=tries, ok=ok)
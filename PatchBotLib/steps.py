@@ -0,0 +1,45 @@
+"""Run steps that depend on each other on a thread pool
+
+A step is a name, a function and the names of the steps it needs. Each
+step starts as soon as everything it needs has finished and is handed a
+dictionary of the results so far. Steps that don't depend on each other
+run at the same time.
+
+Once a step fails nothing new is started. When the running steps finish
+we raise the error of the failed step that comes first in the list.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# steps run at once
+STEP_WORKERS = 4
+
+
+def run_steps(steps, workers=STEP_WORKERS):
+    """Run `steps`, a dictionary of name: (function, [names needed]), and
+    return a dictionary of name: result"""
+    results = {}
+    errors = {}
+    pending = dict(steps)
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            if not errors:
+                for name, (func, needs) in list(pending.items()):
+                    if all(need in results for need in needs):
+                        del pending[name]
+                        running[pool.submit(func, results)] = name
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as err:
+                    errors[name] = err
+    if errors:
+        raise errors[next(name for name in steps if name in errors)]
+    if pending:
+        raise ValueError("Steps never ran: {}".format(", ".join(pending)))
+    return results
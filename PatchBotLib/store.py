@@ -0,0 +1,104 @@
+"""Small on-disk stores shared between PatchBot processes
+
+Several autopkg runs can be going at once on the one build host so all
+access goes through an exclusive file lock and every write replaces the
+file atomically.
+"""
+
+from os import path
+import os
+import json
+import time
+import fcntl
+import tempfile
+from contextlib import contextmanager
+
+CACHE_DIR = path.expanduser("~/Library/Caches/com.honestpuck.PatchBot")
+
+# how long we trust a sticky cookie that came without an expiry (seconds)
+COOKIE_TTL = 3600
+
+# don't hand out anything this close to its expiry (seconds)
+EXPIRY_MARGIN = 60
+
+
+def cache_path(name):
+    """Full path of `name` in our cache directory"""
+    os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+    return path.join(CACHE_DIR, name)
+
+
+@contextmanager
+def locked(name):
+    """Hold the exclusive lock for the store `name`"""
+    with open(cache_path(name + ".lock"), "w") as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+def load_json(name):
+    """Read the JSON store `name`. A missing or damaged store is empty"""
+    try:
+        with open(cache_path(name)) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_json(name, data):
+    """Atomically replace the JSON store `name`, readable only by us"""
+    fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, prefix=name)
+    try:
+        with os.fdopen(fd, "w") as fp:
+            json.dump(data, fp)
+        os.replace(tmp, cache_path(name))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class SessionStore:
+    """The sticky cookie and bearer token for one Jamf server.
+
+    Entries look like `{"value": ..., "expires": <epoch>, "user": ...}`
+    and anything past its expiry is treated as missing so the caller
+    falls back to a fresh handshake."""
+
+    FILE = "sessions.json"
+
+    def __init__(self, server, user):
+        self.server = server
+        self.user = user
+
+    def get(self, kind):
+        """Return the live value for `kind` or None"""
+        with locked(self.FILE):
+            entry = load_json(self.FILE).get(self.server, {}).get(kind)
+        if not entry or entry.get("user") != self.user:
+            return None
+        if entry["expires"] - EXPIRY_MARGIN < time.time():
+            return None
+        return entry["value"]
+
+    def put(self, kind, value, expires=None):
+        """Save `value` for `kind` until `expires` (epoch seconds)"""
+        if expires is None:
+            expires = time.time() + COOKIE_TTL
+        with locked(self.FILE):
+            data = load_json(self.FILE)
+            data.setdefault(self.server, {})[kind] = {
+                "value": value,
+                "expires": expires,
+                "user": self.user,
+            }
+            save_json(self.FILE, data)
+
+    def drop(self, kind):
+        """Forget `kind`, usually because the server rejected it"""
+        with locked(self.FILE):
+            data = load_json(self.FILE)
+            if data.get(self.server, {}).pop(kind, None) is not None:
+                save_json(self.FILE, data)
@@ -0,0 +1,56 @@
+"""Persistent index of patch software title names to IDs
+
+Both PatchManager and Production need the ID of a patch software title
+and the only way to map a name to an ID is to download the full
+`patchsoftwaretitles` list. The ID almost never changes so we keep the
+mapping on disk and only download the list again when the index is
+older than `TITLE_TTL` or doesn't know the title.
+"""
+
+import time
+import xml.etree.ElementTree as ET
+
+from PatchBotLib.store import locked, load_json, save_json
+
+# how long we trust the index before refreshing it (seconds)
+TITLE_TTL = 7 * 24 * 3600
+
+
+class TitleIndex:
+    """Name to ID index of the patch software titles on one server"""
+
+    FILE = "titles.json"
+
+    def __init__(self, server, ttl=TITLE_TTL):
+        self.server = server
+        self.ttl = ttl
+
+    def get(self, name):
+        """ID of title `name` or None if we don't know it or the index
+        is stale. Either way the caller should refresh"""
+        with locked(self.FILE):
+            entry = load_json(self.FILE).get(self.server)
+        if not entry or entry["fetched"] + self.ttl < time.time():
+            return None
+        return entry["titles"].get(name)
+
+    def update(self, root):
+        """Rebuild the index from a freshly downloaded
+        `patchsoftwaretitles` list, either XML text or parsed"""
+        if isinstance(root, (str, bytes)):
+            root = ET.fromstring(root)
+        titles = {}
+        for ps_title in root.findall("patch_software_title"):
+            titles[ps_title.findtext("name")] = ps_title.findtext("id")
+        with locked(self.FILE):
+            data = load_json(self.FILE)
+            data[self.server] = {"fetched": time.time(), "titles": titles}
+            save_json(self.FILE, data)
+        return titles
+
+    def drop(self, name):
+        """Forget `name`, its ID has stopped working"""
+        with locked(self.FILE):
+            data = load_json(self.FILE)
+            if data.get(self.server, {}).get("titles", {}).pop(name, None):
+                save_json(self.FILE, data)
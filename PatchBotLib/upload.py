@@ -0,0 +1,502 @@
+"""Streaming package upload to /dbfileupload
+
+JPCImporter used to shell out to curl for this. We now stream the
+package over the shared session instead, a fixed size chunk at a time
+so memory stays flat on multi-GB packages like Xcode, with a timeout,
+retries on dropped connections and a note of the throughput.
+
+Very big packages on a Jamf Cloud server with JCDS2 go up as an S3
+multipart upload instead. The parts are sent several at a time and a
+manifest of the finished parts lets an interrupted upload carry on
+where it stopped on the next run. That needs boto3, without it we
+stream the package in one go as before.
+
+Either way the package hash for the package record is worked out from
+the same reads that feed the upload so the package is only read once.
+"""
+
+from os import path
+import time
+import hashlib
+import logging
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+
+from PatchBotLib.store import locked, load_json, save_json
+from PatchBotLib import metrics
+
+try:
+    import boto3
+    from botocore.exceptions import BotoCoreError, ClientError
+except ImportError:
+    boto3 = None
+
+# size of each read from the package
+CHUNK_SIZE = 1024 * 1024
+
+# (connect, read) timeout. The server has to store the package before it
+# answers so the read timeout is generous
+UPLOAD_TIMEOUT = (10, 600)
+
+# how many times we start again after the connection drops or times out
+UPLOAD_RETRIES = 2
+
+# log progress every this many percent
+PROGRESS_STEP = 10
+
+# packages this big or bigger go up in parts when the server allows it
+MULTIPART_THRESHOLD = 512 * 1024 * 1024
+
+# size of each part, S3 wants at least 5MB. Each worker holds one part
+# in memory at a time
+PART_SIZE = 16 * 1024 * 1024
+
+# how many parts we send at once
+PART_WORKERS = 4
+
+# Jamf Pro API endpoint that hands out JCDS2 upload credentials
+JCDS_PATH = "/api/v1/jcds/files"
+
+# the hash that goes in the package record. Set HASH_MD5 to have an MD5
+# worked out and logged as well
+HASH_TYPE = "SHA_512"
+HASH_MD5 = False
+HASH_FUNCTIONS = {"SHA_512": hashlib.sha512, "MD5": hashlib.md5}
+
+
+class UploadError(Exception):
+    """The upload failed"""
+
+
+def new_hashes():
+    """Fresh hash objects keyed on the Jamf hash type"""
+    types = [HASH_TYPE]
+    if HASH_MD5 and HASH_TYPE != "MD5":
+        types.append("MD5")
+    return {name: HASH_FUNCTIONS[name]() for name in types}
+
+
+class OrderedHasher:
+    """Hashes a package whose parts are read in any order by several
+    threads. A thread feeding part n waits until parts 1 to n - 1 are
+    done. Parts already uploaded on an earlier run are read back from
+    disk when their turn comes"""
+
+    def __init__(self, pkg_path, skip):
+        self.pkg_path = pkg_path
+        self.skip = set(skip)
+        self.hashes = new_hashes()
+        self.next = 1
+        self.broken = False
+        self.cond = threading.Condition()
+
+    def feed(self, number, data):
+        """Hash `data`, the contents of part `number`"""
+        with self.cond:
+            self._catch_up()
+            while self.next != number and not self.broken:
+                self.cond.wait()
+                self._catch_up()
+            if self.broken:
+                return
+            for value in self.hashes.values():
+                value.update(data)
+            self.next += 1
+            self._catch_up()
+            self.cond.notify_all()
+
+    def fail(self):
+        """A part failed so the hash can never be finished, let every
+        waiting thread go"""
+        with self.cond:
+            self.broken = True
+            self.cond.notify_all()
+
+    def finish(self, count):
+        """The hex digests once all `count` parts are in"""
+        with self.cond:
+            self._catch_up()
+            if self.broken or self.next != count + 1:
+                return {}
+            return {k: v.hexdigest() for k, v in self.hashes.items()}
+
+    def _catch_up(self):
+        while self.next in self.skip:
+            with open(self.pkg_path, "rb") as fp:
+                fp.seek((self.next - 1) * PART_SIZE)
+                left = PART_SIZE
+                while left:
+                    chunk = fp.read(min(CHUNK_SIZE, left))
+                    if not chunk:
+                        break
+                    left -= len(chunk)
+                    for value in self.hashes.values():
+                        value.update(chunk)
+            self.next += 1
+
+
+class ChunkReader:
+    """File-like wrapper around the package that hands out CHUNK_SIZE
+    reads and keeps track of how far we've got. `len()` gives requests
+    the Content-Length so the body isn't sent chunked"""
+
+    def __init__(self, pkg_path, logger):
+        self.fp = open(pkg_path, "rb")
+        self.size = path.getsize(pkg_path)
+        self.logger = logger
+        self.sent = 0
+        self.next_report = PROGRESS_STEP
+        self.hashes = new_hashes()
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        # the caller asks for small blocks, we give it whole chunks
+        chunk = self.fp.read(CHUNK_SIZE)
+        self.sent += len(chunk)
+        for value in self.hashes.values():
+            value.update(chunk)
+        if self.size and self.sent * 100 >= self.next_report * self.size:
+            self.logger.debug("Uploaded %s%%", self.sent * 100 // self.size)
+            self.next_report += PROGRESS_STEP
+        return chunk
+
+    def seek(self, offset, whence=0):
+        """Start again, which is all a retry needs"""
+        self.fp.seek(offset, whence)
+        self.sent = self.fp.tell()
+        self.next_report = PROGRESS_STEP
+        self.hashes = new_hashes()
+        return self.sent
+
+    def digests(self):
+        """Hex digests of everything read since the last seek"""
+        return {k: v.hexdigest() for k, v in self.hashes.items()}
+
+    def tell(self):
+        return self.fp.tell()
+
+    def close(self):
+        self.fp.close()
+
+
+class Uploader:
+    """Uploads packages through a `JamfClient`"""
+
+    def __init__(self, client, logger=None):
+        self.client = client
+        self.logger = logger or logging.getLogger(__name__)
+        # hex digests of the last package uploaded keyed on hash type
+        self.hashes = {}
+
+    def headers(self, pkg):
+        """The headers /dbfileupload uses to describe the file"""
+        return {
+            "DESTINATION": "0",
+            "OBJECT_ID": "-1",
+            "FILE_TYPE": "0",
+            "FILE_NAME": pkg,
+            "Content-Type": "application/octet-stream",
+        }
+
+    def upload(self, pkg_path):
+        """Upload the package at `pkg_path` and return the new package ID"""
+        pkg = path.basename(pkg_path)
+        url = self.client.server + "/dbfileupload"
+        body = ChunkReader(pkg_path, self.logger)
+        packid = None
+        try:
+            attempt = 0
+            while True:
+                attempt += 1
+                body.seek(0)
+                start = time.monotonic()
+                try:
+                    ret = self.client.post(
+                        url,
+                        data=body,
+                        headers=self.headers(pkg),
+                        timeout=UPLOAD_TIMEOUT,
+                    )
+                    break
+                except requests.RequestException as err:
+                    if body.sent == body.size and not isinstance(
+                        err, requests.ConnectTimeout
+                    ):
+                        # the server has it all and may have made the
+                        # record anyway, sending it again could make two
+                        packid = self.existing(pkg)
+                        if packid:
+                            self.logger.warning(
+                                "Upload of %s lost its answer but the "
+                                "package is there: %s",
+                                pkg,
+                                err,
+                            )
+                            break
+                    if attempt > UPLOAD_RETRIES or not isinstance(
+                        err, (requests.ConnectionError, requests.Timeout)
+                    ):
+                        raise UploadError(
+                            "Upload of {} failed: {}".format(pkg, err)
+                        )
+                    self.logger.warning(
+                        "Upload attempt %s of %s dropped: %s", attempt, pkg, err
+                    )
+        finally:
+            body.close()
+        if body.sent == body.size:
+            self.hashes = body.digests()
+            self.log_hashes(pkg)
+        elapsed = time.monotonic() - start
+        metrics.event("upload", pkg, elapsed, bytes=body.size)
+        self.logger.info(
+            "Uploaded %s: %s bytes in %.1fs (%.2f MB/s)",
+            pkg,
+            body.size,
+            elapsed,
+            body.size / elapsed / 1e6 if elapsed else 0,
+        )
+        if packid:
+            return packid
+        if ret.status_code not in (200, 201):
+            raise UploadError(
+                "Upload of {} failed with code: {}".format(pkg, ret.status_code)
+            )
+        try:
+            packid = ET.fromstring(ret.content).findtext("id")
+        except ET.ParseError:
+            packid = None
+        if not packid:
+            raise UploadError("Upload of {} returned no package ID".format(pkg))
+        return packid
+
+    def existing(self, pkg):
+        """ID of the package `pkg` if the server has it or None. The
+        importer has already checked it wasn't there before we started so
+        if it is there now it is ours"""
+        url = self.client.base + "packages/name/{}".format(pkg)
+        self.logger.debug("About to check: %s", url)
+        try:
+            ret = self.client.get(url)
+        except requests.RequestException as err:
+            raise UploadError("Check for {} failed: {}".format(pkg, err))
+        if ret.status_code == 404:
+            return None
+        if ret.status_code != 200:
+            raise UploadError(
+                "Check for {} failed: {}".format(pkg, ret.status_code)
+            )
+        try:
+            return ET.fromstring(ret.content).findtext("id")
+        except ET.ParseError:
+            return None
+
+    def log_hashes(self, pkg):
+        for name, value in self.hashes.items():
+            self.logger.debug("%s %s: %s", pkg, name, value)
+
+    def hash_xml(self):
+        """`hash_type` and `hash_value` elements for the package record
+        or an empty string if we don't have a hash"""
+        if HASH_TYPE not in self.hashes:
+            return ""
+        return "<hash_type>{}</hash_type><hash_value>{}</hash_value>".format(
+            HASH_TYPE, self.hashes[HASH_TYPE]
+        )
+
+
+class Manifest:
+    """The parts of an interrupted multipart upload that are already on
+    the server. Keyed on the package's name, size and modification time
+    so a rebuilt package starts again from scratch"""
+
+    FILE = "uploads.json"
+
+    def __init__(self, server, pkg_path):
+        self.key = "{}|{}|{}|{}".format(
+            server,
+            path.basename(pkg_path),
+            path.getsize(pkg_path),
+            int(path.getmtime(pkg_path)),
+        )
+
+    def get(self):
+        """The saved state, `{"upload_id", "key", "parts"}`, or None"""
+        with locked(self.FILE):
+            return load_json(self.FILE).get(self.key)
+
+    def start(self, upload_id, key):
+        """Record a new upload"""
+        self._update({"upload_id": upload_id, "key": key, "parts": {}})
+
+    def part_done(self, number, etag):
+        """Record a finished part"""
+        with locked(self.FILE):
+            data = load_json(self.FILE)
+            data[self.key]["parts"][str(number)] = etag
+            save_json(self.FILE, data)
+
+    def finish(self):
+        """Forget the upload, it's complete or abandoned"""
+        self._update(None)
+
+    def _update(self, state):
+        with locked(self.FILE):
+            data = load_json(self.FILE)
+            if state is None:
+                data.pop(self.key, None)
+            else:
+                data[self.key] = state
+            save_json(self.FILE, data)
+
+
+class MultipartUploader(Uploader):
+    """Uploads big packages to JCDS2 in parallel parts that survive an
+    interrupted run. Anything else goes through `Uploader`"""
+
+    def upload(self, pkg_path):
+        """Upload the package at `pkg_path` and return the new package ID"""
+        if path.getsize(pkg_path) < MULTIPART_THRESHOLD or boto3 is None:
+            return super().upload(pkg_path)
+        creds = self.credentials()
+        if creds is None:
+            return super().upload(pkg_path)
+        pkg = path.basename(pkg_path)
+        start = time.monotonic()
+        try:
+            self.multipart(pkg_path, creds)
+        except (BotoCoreError, ClientError, OSError) as err:
+            raise UploadError("Upload of {} failed: {}".format(pkg, err))
+        elapsed = time.monotonic() - start
+        size = path.getsize(pkg_path)
+        metrics.event("upload", pkg, elapsed, bytes=size, parts=True)
+        self.logger.info(
+            "Uploaded %s in parts: %s bytes in %.1fs (%.2f MB/s)",
+            pkg,
+            size,
+            elapsed,
+            size / elapsed / 1e6 if elapsed else 0,
+        )
+        return self.create_record(pkg)
+
+    def credentials(self):
+        """Temporary S3 credentials for JCDS2 or None if the server
+        doesn't have it"""
+        ret = self.client.post(
+            self.client.server + JCDS_PATH,
+            headers={"Accept": "application/json"},
+        )
+        if ret.status_code not in (200, 201):
+            self.logger.debug("No JCDS2: %s", ret.status_code)
+            return None
+        return ret.json()
+
+    def multipart(self, pkg_path, creds):
+        """Send the parts of `pkg_path` that aren't already there"""
+        pkg = path.basename(pkg_path)
+        s3 = boto3.client(
+            "s3",
+            aws_access_key_id=creds["accessKeyID"],
+            aws_secret_access_key=creds["secretAccessKey"],
+            aws_session_token=creds["sessionToken"],
+            region_name=creds["region"],
+            # only the local stand-in server sends this
+            endpoint_url=creds.get("endpointUrl"),
+        )
+        bucket = creds["bucketName"]
+        key = creds["path"] + pkg
+        manifest = Manifest(self.client.server, pkg_path)
+        state = manifest.get()
+        if state and state["key"] == key:
+            self.logger.info(
+                "Resuming %s with %s parts done", pkg, len(state["parts"])
+            )
+        else:
+            ret = s3.create_multipart_upload(Bucket=bucket, Key=key)
+            manifest.start(ret["UploadId"], key)
+            state = manifest.get()
+        upload_id = state["upload_id"]
+        done = {int(n): etag for n, etag in state["parts"].items()}
+        count = -(-path.getsize(pkg_path) // PART_SIZE)
+        todo = [n for n in range(1, count + 1) if n not in done]
+        self.logger.debug("%s: %s parts, %s to send", pkg, count, len(todo))
+        hasher = OrderedHasher(pkg_path, done)
+        errors = []
+        with ThreadPoolExecutor(PART_WORKERS) as pool:
+            futures = {
+                pool.submit(
+                    self.put_part, s3, bucket, key, upload_id, pkg_path, n,
+                    hasher
+                ): n
+                for n in todo
+            }
+            # keep going after a failure so every part that did make it
+            # is in the manifest for next time
+            for future in as_completed(futures):
+                n = futures[future]
+                try:
+                    done[n] = future.result()
+                except Exception as err:
+                    hasher.fail()
+                    errors.append(err)
+                    continue
+                manifest.part_done(n, done[n])
+                self.logger.debug("Part %s of %s done", n, count)
+        if errors:
+            err = errors[0]
+            if isinstance(err, ClientError) and (
+                err.response.get("Error", {}).get("Code") == "NoSuchUpload"
+            ):
+                # the server threw our parts away, start again next time
+                manifest.finish()
+            raise err
+        s3.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={
+                "Parts": [
+                    {"ETag": done[n], "PartNumber": n} for n in sorted(done)
+                ]
+            },
+        )
+        manifest.finish()
+        self.hashes = hasher.finish(count)
+        self.log_hashes(pkg)
+
+    def put_part(self, s3, bucket, key, upload_id, pkg_path, number, hasher):
+        """Send part `number` and return its ETag"""
+        try:
+            with open(pkg_path, "rb") as fp:
+                fp.seek((number - 1) * PART_SIZE)
+                body = fp.read(PART_SIZE)
+            hasher.feed(number, body)
+        except BaseException:
+            # the parts after ours would wait for us for ever
+            hasher.fail()
+            raise
+        ret = s3.upload_part(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=number,
+            Body=body,
+        )
+        return ret["ETag"]
+
+    def create_record(self, pkg):
+        """Create the package record for the file now in JCDS2"""
+        url = self.client.base + "packages/id/0"
+        data = "<package><name>{0}</name><filename>{0}</filename></package>"
+        ret = self.client.post(url, data=data.format(pkg))
+        if ret.status_code != 201:
+            raise UploadError(
+                "Package record for {} failed with code: {}".format(
+                    pkg, ret.status_code
+                )
+            )
+        return ET.fromstring(ret.content).findtext("id")
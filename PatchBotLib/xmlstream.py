@@ -0,0 +1,48 @@
+"""Streaming parse of large Jamf XML responses
+
+A patch software title for something like Firefox carries hundreds of
+`versions/version` records and we only ever want one of them. Rather
+than decode the whole body to a str and build the full tree we parse
+the response stream as it arrives, throw away each record once it has
+been looked at and stop as soon as we have what we came for.
+"""
+
+import xml.etree.ElementTree as ET
+
+# read size when draining a response we've stopped parsing
+DRAIN_CHUNK = 64 * 1024
+
+
+class _Reader:
+    """File-like view of a streamed response that undoes any gzip"""
+
+    def __init__(self, ret):
+        self.raw = ret.raw
+
+    def read(self, size=-1):
+        return self.raw.read(size, decode_content=True)
+
+
+def iter_records(ret, tag, parent):
+    """Yield each `tag` element inside a `parent` element of the streamed
+    response `ret` as soon as it is complete. Each one is dropped from
+    the tree after the consumer has seen it so memory stays flat however
+    long the list. `ret` must come from a request made with
+    `stream=True`"""
+    stack = []
+    for event, elem in ET.iterparse(_Reader(ret), events=("start", "end")):
+        if event == "start":
+            stack.append(elem)
+            continue
+        stack.pop()
+        if elem.tag == tag and stack and stack[-1].tag == parent:
+            yield elem
+            stack[-1].remove(elem)
+
+
+def drain(ret):
+    """Read and discard the rest of `ret` so the connection goes back to
+    the pool rather than being closed"""
+    for _ in ret.iter_content(DRAIN_CHUNK):
+        pass
+    ret.close()
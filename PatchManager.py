@@ -9,17 +9,34 @@
 """See docstring for PatchManager class"""
 
 from os import path
+import sys
 import plistlib
 import xml.etree.ElementTree as ET
+import copy
 import datetime
-import logging.handlers
-import requests
+import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from autopkglib import Processor, ProcessorError
 
+# AutoPkg doesn't put our directory on the path for the shared library
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+from PatchBotLib.client import get_client, parsed  # noqa: E402
+from PatchBotLib.titles import TitleIndex  # noqa: E402
+from PatchBotLib.patchtitle import find_version, title_document  # noqa: E402
+from PatchBotLib.xmlstream import drain  # noqa: E402
+from PatchBotLib.catalog import get_catalog, CatalogError  # noqa: E402
+from PatchBotLib.ratelimit import TokenBucket, RATE, limits  # noqa: E402
+from PatchBotLib import metrics  # noqa: E402
+from PatchBotLib.profiling import profiled  # noqa: E402
+from PatchBotLib.logs import get_logger, Payload  # noqa: E402
+
 APPNAME = "PatchManager"
 LOGLEVEL = logging.DEBUG
 
+# titles worked on at once in batch mode
+WORKERS = 8
+
 __all__ = [APPNAME]
 
 
@@ -42,10 +59,30 @@ class PatchManager(Processor):
 
     input_variables = {
         "package": {
-            "required": True,
+            "required": False,
             "description": "App part of package name"
         },
         "patch": {"required": False, "description": "Patch name"},
+        "packages": {
+            "required": False,
+            "description": "Batch mode. A list of dictionaries each with "
+            "package and optionally patch",
+        },
+        "workers": {
+            "required": False,
+            "description": "Batch mode titles worked on at once, "
+            "default %s" % WORKERS,
+        },
+        "rate": {
+            "required": False,
+            "description": "Batch mode API requests a second, "
+            "default %s" % RATE,
+        },
+        "profile": {
+            "required": False,
+            "description": "Profile the run, the results go next to the "
+            "log file. PATCHBOT_PROFILE=1 does the same",
+        },
     }
     output_variables = {
         "patch_manager_summary_result": {"description": "Summary of action"}
@@ -55,30 +92,10 @@ class PatchManager(Processor):
 
     def setup_logging(self):
         """Defines a nicely formatted logger"""
-        LOGFILE = "/usr/local/var/log/%s.log" % APPNAME
+        self.logger = get_logger(APPNAME, LOGLEVEL)
 
-        self.logger = logging.getLogger(APPNAME)
-        # we may be the second and subsequent iterations of JPCImporter
-        # and already have a handler.
-        if len(self.logger.handlers):
-            return
-        ch = logging.handlers.TimedRotatingFileHandler(
-            LOGFILE, when="D", interval=1, backupCount=7
-        )
-        ch.setFormatter(
-            logging.Formatter(
-                "%(asctime)s %(levelname)s %(message)s",
-                datefmt="%Y-%m-%d %H:%M:%S",
-            )
-        )
-        self.logger.addHandler(ch)
-        self.logger.setLevel(LOGLEVEL)
-
-    def policy(self):
-        """Download the TEST policy for the app and return version string"""
-        self.logger.warning(
-            "******** Starting policy %s *******" % self.pkg.package
-        )
+    def load_prefs(self):
+        """load the preferences from file and set up our client"""
         # Which pref format to use, autopkg or jss_importer
         autopkg = True
         if autopkg:
@@ -88,72 +105,79 @@ class PatchManager(Processor):
             fp = open(plist, "rb")
             prefs = plistlib.load(fp)
             server = prefs["JSS_URL"]
-            self.base = server + "/JSSResource/"
-            self.auth = (prefs["API_USERNAME"], prefs["API_PASSWORD"])
+            auth = (prefs["API_USERNAME"], prefs["API_PASSWORD"])
         else:
             plist = path.expanduser("~/Library/Preferences/JPCImporter.plist")
             fp = open(plist, "rb")
             prefs = plistlib.load(fp)
             server = prefs["url"]
-            self.base = server + "/JSSResource/"
-            self.auth = (prefs["user"], prefs["password"])
+            auth = (prefs["user"], prefs["password"])
 
-        # let's use the cookies to make sure we hit the
-        # same server for every request.
-        # the complication here is that ordinary and Premium Jamfers
-        # get two DIFFERENT cookies for this.
-
-        # the front page will give us the cookies
-        r = requests.get(server)
+        # the shared client looks after the sticky cookie so we hit the
+        # same server for every request
+        try:
+            rates = limits(prefs)
+        except ValueError as err:
+            raise ProcessorError(str(err))
+        self.client = get_client(server, auth, rates)
+        self.base = self.client.base
+        self.titles = TitleIndex(self.client.server)
 
-        cookie_value = r.cookies.get('APBALANCEID')
-        if cookie_value:
-            # we are NOT premium Jamf Cloud
-            self.cookies = dict(APBALANCEID=cookie_value)
-        else:
-            cookie_value = r.cookies['AWSALB']
-            self.cookies = dict(AWSALB=cookie_value)
+    def policy(self):
+        """Download the TEST policy for the app and return version string"""
+        self.logger.warning(
+            "******** Starting policy %s *******", self.pkg.package
+        )
+        self.load_prefs()
         policy_name = "TEST-{}".format(self.pkg.package)
         url = self.base + "policies/name/{}".format(policy_name)
-        self.logger.debug(
-            "About to make request URL %s, auth %s" % (url, self.auth)
-        )
-        ret = requests.get(url, auth=self.auth, cookies=self.cookies)
+        self.logger.debug("About to make request URL %s", url)
+        # we only want the package so skip the scope, scripts and so on
+        ret = self.client.get_subset(url, ("General", "PackageConfiguration"))
         if ret.status_code != 200:
             self.logger.debug(
-                "TEST Policy %s not found error: %s"
-                % (policy_name, ret.status_code)
+                "TEST Policy %s not found error: %s",
+                policy_name,
+                ret.status_code,
             )
             raise ProcessorError(
                 "Policy get for: %s failed with code: %s"
                 % (url, ret.status_code)
             )
         self.logger.debug("TEST policy found")
-        root = ET.fromstring(ret.text)
+        root = parsed(ret)
         try:
             self.pkg.idn = root.find(
                 "package_configuration/packages/package/id"
             ).text
         except AttributeError:
             self.logger.debug(
-                f"Missing package definition in policy: {policy_name}")
+                "Missing package definition in policy: %s", policy_name
+            )
             raise ProcessorError("Missing package definition")
         self.pkg.name = root.find(
             "package_configuration/packages/package/name"
         ).text
         self.logger.debug(
-            "Version in TEST Policy %s " %
-            self.pkg.name.split("-", 1)[1][:-4]
+            "Version in TEST Policy %s ", self.pkg.name.split("-", 1)[1][:-4]
         )
+        self.check_latest()
         # return the version number
         return self.pkg.name.split("-", 1)[1][:-4]
 
-    def patch(self):
-        """Now we check for, then update the patch definition"""
+    def title_id(self, refresh=False):
+        """Find the ID of our patch software title, from the title index
+        if it knows it, otherwise from the list of titles"""
+        ident = None
+        if not refresh:
+            ident = self.titles.get(self.pkg.patch)
+        if ident:
+            self.logger.debug("PST ID from index")
+            return ident
         # download the list of titles
         url = self.base + "patchsoftwaretitles"
         self.logger.debug("About to request PST list %s", url)
-        ret = requests.get(url, auth=self.auth, cookies=self.cookies)
+        ret = self.client.get(url)
         if ret.status_code != 200:
             raise ProcessorError(
                 "Patch list download failed: {} : {}".format(
@@ -161,22 +185,49 @@ class PatchManager(Processor):
                 )
             )
         self.logger.debug("Got PST list")
-        root = ET.fromstring(ret.text)
-        # loop through 'patchsoftwaretitles' list to find our title
-        ident = 0
-        for ps_title in root.findall("patch_software_title"):
-            if ps_title.findtext("name") == self.pkg.patch:
-                ident = ps_title.findtext("id")
-                self.logger.debug("PST ID found")
-                break
-        if ident == 0:
+        # other titles may be reading the same list
+        ident = self.titles.update(parsed(ret)).get(self.pkg.patch)
+        if not ident:
             raise ProcessorError(
                 f"Patch list did not contain title: {self.pkg.patch}"
             )
+        return ident
+
+    def check_latest(self):
+        """Warn if the TEST policy isn't on our newest package. Only
+        worth it if we have the package list already, it isn't worth
+        downloading just for this"""
+        catalog = get_catalog(self.client)
+        try:
+            if not catalog.ready():
+                return
+            latest = catalog.latest(self.pkg.package)
+        except CatalogError as err:
+            self.logger.debug("Catalog failed: %s", err)
+            return
+        if latest and latest[1] != self.pkg.name:
+            self.logger.warning(
+                "TEST policy has %s but the newest package is %s",
+                self.pkg.name,
+                latest[1],
+            )
+
+    def patch(self):
+        """Now we check for, then update the patch definition"""
+        ident = self.title_id()
         # get the patch list for our title
         url = self.base + "patchsoftwaretitles/id/" + str(ident)
-        self.logger.debug("About to request PST by ID: %s" % url)
-        ret = requests.get(url, auth=self.auth, cookies=self.cookies)
+        self.logger.debug("About to request PST by ID: %s", url)
+        # titles can be huge so we stream it and stop at our version
+        ret = self.client.get(url, stream=True)
+        if ret.status_code == 404:
+            # the title has been replaced since we indexed it
+            drain(ret)
+            self.titles.drop(self.pkg.patch)
+            ident = self.title_id(refresh=True)
+            url = self.base + "patchsoftwaretitles/id/" + str(ident)
+            self.logger.debug("About to request PST by new ID: %s", url)
+            ret = self.client.get(url, stream=True)
         if ret.status_code != 200:
             raise ProcessorError(
                 "Patch software download failed: {} : {}".format(
@@ -184,24 +235,9 @@ class PatchManager(Processor):
                 )
             )
         self.logger.debug("Got our PST")
-        root = ET.fromstring(ret.text)
         # find the patch version that matches our version
-        done = False
-        for record in root.findall("versions/version"):
-            if self.pkg.version in record.findtext("software_version"):
-                software_version = record.findtext("software_version")
-                self.logger.debug("Found our version")
-                if record.findtext("package/name"):
-                    self.logger.debug("Definition already points to package")
-                    return 0
-                package = record.find("package")
-                add = ET.SubElement(package, "id")
-                add.text = self.pkg.idn
-                add = ET.SubElement(package, "name")
-                add.text = self.pkg.name
-                done = True
-                break
-        if not done:
+        record = find_version(ret, self.pkg.version)
+        if record is None:
             # this isn't really an error but we want to know anyway
             # and we need to exit so raising an error is the easiest way to
             # do that feeding info to Teams
@@ -210,11 +246,20 @@ class PatchManager(Processor):
                     str(ident), self.pkg.name, self.pkg.version
                 )
             )
+        software_version = record.findtext("software_version")
+        self.logger.debug("Found our version")
+        if record.findtext("package/name"):
+            self.logger.debug("Definition already points to package")
+            return 0
+        package = record.find("package")
+        add = ET.SubElement(package, "id")
+        add.text = self.pkg.idn
+        add = ET.SubElement(package, "name")
+        add.text = self.pkg.name
         # update the patch def
-        data = ET.tostring(root)
-        self.logger.debug("About to put PST: %s" % url)
-        ret = requests.put(url, auth=self.auth,
-                data=data, cookies=self.cookies)
+        data = ET.tostring(title_document(record))
+        self.logger.debug("About to put PST: %s", url)
+        ret = self.client.put(url, data=data)
         if ret.status_code != 201:
             raise ProcessorError(
                 "Patch definition update failed with code: %s"
@@ -224,28 +269,28 @@ class PatchManager(Processor):
         # now the patch policy - this will be a journey as well
         # first get the list of patch policies for our software title
         url = f"{self.base}patchpolicies/softwaretitleconfig/id/{str(ident)}"
-        self.logger.debug("About to request patch list: %s" % url)
-        ret = requests.get(url, auth=self.auth, cookies=self.cookies)
+        self.logger.debug("About to request patch list: %s", url)
+        ret = self.client.get(url)
         if ret.status_code != 200:
             raise ProcessorError(
                 "Patch policy list download failed: {} : {}".format(
                     str(ident), self.pkg.name
                 )
             )
-        root = ET.fromstring(ret.text)
+        root = parsed(ret)
         # loop through policies for the Test one
         pol_list = root.findall("patch_policy")
-        self.logger.debug("Got the PP list and name is: %s" % self.pkg.name)
+        self.logger.debug("Got the PP list and name is: %s", self.pkg.name)
         for pol in pol_list:
             # now grab policy
             self.logger.debug(
-                "examining patch policy %s" % pol.findtext("name")
+                "examining patch policy %s", pol.findtext("name")
             )
             if "Test" in pol.findtext("name"):
                 pol_id = pol.findtext("id")
                 url = self.base + "patchpolicies/id/" + str(pol_id)
-                self.logger.debug("About to request PP by ID: %s" % url)
-                ret = requests.get(url, auth=self.auth, cookies=self.cookies)
+                self.logger.debug("About to request PP by ID: %s", url)
+                ret = self.client.get(url)
                 if ret.status_code != 200:
                     raise ProcessorError(
                         "Patch policy download failed: {} : {}".format(
@@ -253,19 +298,19 @@ class PatchManager(Processor):
                         )
                     )
                 # now edit the patch policy
-                root = ET.fromstring(ret.text)
+                with metrics.timed("parse", metrics.endpoint(url)):
+                    root = ET.fromstring(ret.text)
                 self.logger.debug(
-                    "Got patch policy with version : %s : and we are : %s :"
-                    % (
-                        root.findtext("general/target_version"),
-                        self.pkg.version,
-                    )
+                    "Got patch policy with version : %s : and we are : %s :",
+                    root.findtext("general/target_version"),
+                    self.pkg.version,
                 )
-                if root.findtext("general/target_version") == 
-                        self.pkg.version:
+                if root.findtext("general/target_version") == (
+                    self.pkg.version
+                ):
                     # we have already done this version
                     self.logger.debug(
-                        "Version %s already done" % self.pkg.version
+                        "Version %s already done", self.pkg.version
                     )
                     return 0
                 root.find("general/target_version").text = software_version
@@ -278,12 +323,11 @@ class PatchManager(Processor):
                     "user_interaction/self_service_description"
                 ).text = desc
                 data = ET.tostring(root)
-                self.logger.debug("About to change PP: %s" % url)
-                ret = requests.put(url, auth=self.auth, 
-                    data=data, cookies=self.cookies)
+                self.logger.debug("About to change PP: %s", url)
+                ret = self.client.put(url, data=data)
                 if ret.status_code != 201:
-                    self.logger.debug(ret.text)
-                    self.logger.debug(data)
+                    self.logger.debug("Response: %s", Payload(ret.content))
+                    self.logger.debug("Sent: %s", Payload(data))
                     raise ProcessorError(
                         "Patch policy update failed with code: %s"
                         % ret.status_code
@@ -293,6 +337,80 @@ class PatchManager(Processor):
                 return pol_id
         raise ProcessorError("Test patch policy missing")
 
+    def job(self, args):
+        """build a Package from a dictionary of recipe arguments"""
+        pkg = Package()
+        pkg.package = args.get("package")
+        if not pkg.package:
+            raise ProcessorError("No package in: {}".format(args))
+        pkg.patch = args.get("patch") or pkg.package
+        return pkg
+
+    def run(self, pkg):
+        """policy() and patch() for `pkg` on a copy of ourselves so that
+        titles can be worked on at the same time. Returns the patch
+        policy ID or 0"""
+        worker = copy.copy(self)
+        worker.pkg = pkg
+        pkg.version = worker.policy()
+        return worker.patch()
+
+    def batch(self, jobs):
+        """Work on all `jobs` at once through one client and one rate
+        limit. Returns [(pkg, pol_id)] for the ones sent to test"""
+        self.load_prefs()
+        rate = float(self.env.get("rate") or RATE)
+        workers = int(self.env.get("workers") or WORKERS)
+        # the client is shared with every recipe in the run so our rate
+        # limit only lasts as long as the batch
+        limiter = self.client.limiter
+        self.client.limiter = TokenBucket(rate)
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [(pkg, pool.submit(self.run, pkg)) for pkg in jobs]
+        finally:
+            self.client.limiter = limiter
+        done = []
+        errors = []
+        for pkg, future in futures:
+            try:
+                pol_id = future.result()
+            except ProcessorError as err:
+                errors.append(f"{pkg.package}: {err}")
+                continue
+            except Exception as err:
+                # one title going wrong mustn't lose the others
+                errors.append(
+                    f"{pkg.package}: {type(err).__name__}: {err}"
+                )
+                continue
+            if pol_id != 0:
+                done.append((pkg, pol_id))
+        self.logger.info("%s titles, %s sent to test", len(jobs), len(done))
+        if errors:
+            # we still want the summary for the ones that worked
+            self.summary(done)
+            raise ProcessorError("; ".join(errors))
+        return done
+
+    def summary(self, done):
+        """Set the summary for the [(pkg, pol_id)] sent to test"""
+        if not done:
+            return
+        self.env["patch_manager_summary_result"] = {
+            "summary_text": "These packages were sent to test:",
+            "report_fields": ["patch_id", "package", "version"],
+            "data": {
+                "patch_id": ", ".join(str(pol_id) for _, pol_id in done),
+                "package": ", ".join(pkg.package for pkg, _ in done),
+                "version": ", ".join(pkg.version for pkg, _ in done),
+            },
+        }
+        for pkg, _ in done:
+            print("%s version %s sent to test" % (pkg.package, pkg.version))
+
+    @metrics.instrumented("patch_manager_summary_result")
+    @profiled
     def main(self):
         """Do it!"""
         self.setup_logging()
@@ -300,29 +418,20 @@ class PatchManager(Processor):
         # clear any pre-exising summary result
         if "patch_manager_summary_result" in self.env:
             del self.env["patch_manager_summary_result"]
+        # in batch mode a single recipe hands us all the titles and we
+        # work on them at the same time
+        batch = self.env.get("packages")
+        if batch:
+            self.summary(self.batch([self.job(args) for args in batch]))
+            return
         self.logger.debug("About to update package")
-        self.pkg.package = self.env.get("package")
-        self.pkg.patch = self.env.get("patch")
-        if not self.pkg.patch:
-            self.pkg.patch = self.pkg.package
+        self.pkg = self.job(self.env)
         self.pkg.version = self.policy()
         pol_id = self.patch()
         if pol_id != 0:
-            self.env["patch_manager_summary_result"] = {
-                "summary_text": "These packages were sent to test:",
-                "report_fields": ["patch_id", "package", "version"],
-                "data": {
-                    "patch_id": pol_id,
-                    "package": self.pkg.package,
-                    "version": self.pkg.version,
-                },
-            }
-            print(
-                "%s version %s sent to test"
-                % (self.pkg.package, self.pkg.version)
-            )
+            self.summary([(self.pkg, pol_id)])
         else:
-            self.logger.debug("Zero policy id %s" % self.pkg.patch)
+            self.logger.debug("Zero policy id %s", self.pkg.patch)
 
 
 if __name__ == "__main__":
@@ -10,14 +10,27 @@
 """See docstring for Production class"""
 
 from os import path
+import sys
 import plistlib
 import xml.etree.ElementTree as ET
 import datetime
-import logging.handlers
-import requests
+import threading
+import logging
 
 from autopkglib import Processor, ProcessorError
 
+# AutoPkg doesn't put our directory on the path for the shared library
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+from PatchBotLib.client import get_client  # noqa: E402
+from PatchBotLib.ratelimit import limits  # noqa: E402
+from PatchBotLib.titles import TitleIndex  # noqa: E402
+from PatchBotLib.patchtitle import find_version, title_document  # noqa: E402
+from PatchBotLib.patchtitle import set_package  # noqa: E402
+from PatchBotLib.steps import run_steps  # noqa: E402
+from PatchBotLib import metrics  # noqa: E402
+from PatchBotLib.profiling import profiled  # noqa: E402
+from PatchBotLib.logs import get_logger  # noqa: E402
+
 APPNAME = "Production"
 LOGLEVEL = logging.DEBUG
 
@@ -27,6 +40,10 @@ DEFAULT_DELTA = 7
 # default for self service deadline (days)
 DEFAULT_DEADLINE = 7
 
+# all we read or change in a patch policy and in the Test policy
+PP_SUBSETS = ("General", "UserInteraction")
+TEST_SUBSETS = ("General", "PackageConfiguration")
+
 
 __all__ = [APPNAME]
 
@@ -40,6 +57,97 @@ class Package:
     name = ""  # full name of the package '<package>-<version>.pkg'
     version = ""  # the version of our package
     idn = ""  # id of the package in our JP server
+    delta = DEFAULT_DELTA  # days in test before production
+    deadline = DEFAULT_DEADLINE  # self service deadline (days)
+
+
+class Context:
+    """Everything we fetch from JP in a run. The delta check reads most
+    of what the promotion needs so we keep it rather than fetch it again.
+    This also counts our API calls. Promotion steps run in parallel so
+    it has to be thread safe.
+
+    PUTs are the slowest calls so we keep each XML document as it was
+    fetched and skip the PUT if the edits haven't changed it."""
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = 0
+        self.skipped = 0  # PUTs we didn't need to make
+        self.objects = {}  # parsed documents keyed on (url, json)
+        self.fetched = {}  # url -> XML as the server has it
+        self.lock = threading.Lock()
+        self.locks = {}  # one per key so a document is only fetched once
+
+    def count(self):
+        with self.lock:
+            self.calls += 1
+
+    def skip(self, url):
+        """We didn't PUT `url` as nothing had changed"""
+        with self.lock:
+            self.skipped += 1
+        logging.getLogger(APPNAME).debug("Unchanged, not updating: %s", url)
+
+    def fetch(self, url, error, json=False, subsets=None):
+        """GET `url` and parse it, only once per run. With `subsets` we
+        only ask for those sections. Raises ProcessorError with `error`
+        if the GET fails"""
+        key = (url, json, subsets)
+        with self.lock:
+            lock = self.locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self.objects:
+                # the API defaults to XML so we only ask when we want JSON
+                headers = {"accept": "application/json"} if json else None
+                if subsets:
+                    ret = self.client.get_subset(url, subsets, headers=headers)
+                else:
+                    ret = self.client.get(url, headers=headers)
+                self.count()
+                if ret.status_code != 200:
+                    raise ProcessorError(
+                        "{}: {} : {}".format(error, ret.status_code, url)
+                    )
+                with metrics.timed("parse", metrics.endpoint(url)):
+                    if json:
+                        self.objects[key] = ret.json()
+                    else:
+                        self.objects[key] = ET.fromstring(ret.text)
+                        self.fetched[url] = ET.tostring(self.objects[key])
+            return self.objects[key]
+
+    def stream(self, url, error, missing=False):
+        """GET `url` as a stream for documents too big to parse whole.
+        These aren't cached. With `missing` a 404 returns None"""
+        ret = self.client.get(url, stream=True)
+        self.count()
+        if ret.status_code == 404 and missing:
+            ret.close()
+            return None
+        if ret.status_code != 200:
+            ret.close()
+            raise ProcessorError(
+                "{}: {} : {}".format(error, ret.status_code, url)
+            )
+        return ret
+
+    def put(self, url, root, error):
+        """PUT the edited document `root` back to `url` unless it is
+        what we fetched. Our copy now matches the server so it stays in
+        the cache. Returns False if there was nothing to do"""
+        data = ET.tostring(root)
+        if self.fetched.get(url) == data:
+            self.skip(url)
+            return False
+        ret = self.client.put(url, data=data)
+        self.count()
+        if ret.status_code != 201:
+            raise ProcessorError(
+                "{}: {} : {}".format(error, ret.status_code, url)
+            )
+        self.fetched[url] = data
+        return True
 
 
 class Production(Processor):
@@ -48,17 +156,27 @@ class Production(Processor):
     description = __doc__
 
     input_variables = {
-        "package": {"required": True, "description": "Package name"},
+        "package": {"required": False, "description": "Package name"},
         "patch": {"required": False, "description": "Patch name"},
         "delta": {"required": False, "description": "Days in test"},
         "deadline": {"required": False, "description": "Days to deadline"},
+        "packages": {
+            "required": False,
+            "description": "Batch mode. A list of dictionaries each with "
+            "package and optionally patch, delta and deadline",
+        },
+        "profile": {
+            "required": False,
+            "description": "Profile the run, the results go next to the "
+            "log file. PATCHBOT_PROFILE=1 does the same",
+        },
     }
 
     output_variables = {
         "production_summary_result": {"description": "Summary of action"}
     }
 
-    # a package
+    # the package we are working on
     pkg = Package()
 
     def load_prefs(self):
@@ -77,56 +195,43 @@ class Production(Processor):
             prefs = plistlib.load(open(plist, "rb"))
             url = prefs["url"]
             auth = (prefs["user"], prefs["password"])
-        base = url + "/JSSResource"
-        # some API calls we want the JSON. NOTE: Since the API defaults to XML
-        # we can just not pass headers for those calls and we get the XML
-        self.hdrs = {"accept": "application/json"}
+        # the shared client looks after the sticky cookie so we hit the
+        # same server for every request
+        try:
+            rates = limits(prefs)
+        except ValueError as err:
+            raise ProcessorError(str(err))
+        self.client = get_client(url, auth, rates)
+        self.titles = TitleIndex(self.client.server)
+        base = self.client.server + "/JSSResource"
         return (base, auth)
 
     def setup_logging(self):
         """Defines a nicely formatted logger"""
-        LOGFILE = "/usr/local/var/log/%s.log" % APPNAME
-
-        self.logger = logging.getLogger(APPNAME)
-        # we may be the second and subsequent iterations of JPCImporter
-        # and already have a handler.
-        if len(self.logger.handlers):
-            return
-        ch = logging.handlers.TimedRotatingFileHandler(
-            LOGFILE, when="D", interval=1, backupCount=7
-        )
-        ch.setFormatter(
-            logging.Formatter(
-                "%(asctime)s %(levelname)s %(message)s",
-                datefmt="%Y-%m-%d %H:%M:%S",
-            )
-        )
-        self.logger.addHandler(ch)
-        self.logger.setLevel(LOGLEVEL)
+        self.logger = get_logger(APPNAME, LOGLEVEL)
 
     def check_delta(self):
         now = datetime.datetime.now()
         name = f"{self.pkg.patch} Test"
-        self.logger.debug(f"About to policy_list, name: {name}")
+        self.logger.debug("About to policy_list, name: %s", name)
         policies = self.policy_list()
         self.logger.debug("done policy_list")
         try:
             policy_id = policies[name]
         except KeyError:
             raise ProcessorError("Test policy key missing: {}".format(name))
-        self.logger.debug(f"Got valid policy id: {policy_id}")
+        self.logger.debug("Got valid policy id: %s", policy_id)
+        # we get the XML as patch() needs it again to disable the policy
         policy = self.policy(str(policy_id))
-        # self.logger.debug(f"back from policy(): {policy}")
-        if policy["general"]["enabled"] is False:
+        enabled = policy.findtext("general/enabled")
+        if enabled == "false":
             self.logger.debug("TEST patch policy disabled")
             return False
         else:
-            self.logger.debug(
-                f"['general']['enabled'] :{policy['general']['enabled']}"
-            )
-        description = policy["user_interaction"][
-            "self_service_description"
-        ].split()
+            self.logger.debug("general/enabled :%s", enabled)
+        description = (
+            policy.findtext("user_interaction/self_service_description") or ""
+        ).split()
         # we may have found a patch policy with no proper description yet
         if len(description) != 3:
             return False
@@ -134,11 +239,11 @@ class Production(Processor):
 
         date = datetime.datetime.strptime(datestr, "(%Y-%m-%d)")
         delta = now - date
-        self.logger.debug(f"    Description:{description}")
-        self.logger.debug(f"    Datestr    :{datestr}")
-        self.logger.debug(f"    Date       :{date}")
-        self.logger.debug(f"    Delta      :{delta.days}")
-        self.logger.debug(f"    PkgDelta   :{self.pkg.delta}")
+        self.logger.debug("    Description:%s", description)
+        self.logger.debug("    Datestr    :%s", datestr)
+        self.logger.debug("    Date       :%s", date)
+        self.logger.debug("    Delta      :%s", delta.days)
+        self.logger.debug("    PkgDelta   :%s", self.pkg.delta)
 
         if delta.days >= self.pkg.delta:
             return True
@@ -150,283 +255,312 @@ class Production(Processor):
         url = self.base + "/policies/name/Test-" + self.pkg.package
         pack_base = "package_configuration/packages/package"
         self.logger.debug("About to request %s", url)
-        ret = requests.get(url, auth=self.auth, cookies=self.cookies)
-        if ret.status_code != 200:
-            raise ProcessorError(
-                "Test policy download failed: {} : {}".format(
-                    ret.status_code, url
-                )
-            )
-        policy = ET.fromstring(ret.text)
+        policy = self.ctx.fetch(
+            url, "Test policy download failed", subsets=TEST_SUBSETS
+        )
         test_id = policy.findtext("general/id")
         self.logger.debug("Got test policy id %s", test_id)
         self.pkg.idn = policy.findtext(pack_base + "/id")
         self.pkg.name = policy.findtext(pack_base + "/name")
         self.pkg.version = self.pkg.name.split("-", 1)[1][:-4]
 
+    def install_policy(self):
+        """the production policy, fetched while we look up the package"""
+        url = self.base + "/policies/name/Install " + self.pkg.package
+        self.logger.debug("About to request %s", url)
+        return (url, self.ctx.fetch(url, "Prod policy download failed"))
+
     def production(self):
         """change the package in the production policy"""
-        url = self.base + "/policies/name/Install " + self.pkg.package
+        (url, prod) = self.install_policy()
         pack_base = "package_configuration/packages/package"
-        self.logger.debug("About to request %s", url)
-        ret = requests.get(url, auth=self.auth, cookies=self.cookies)
-        self.logger.debug("After get status: %i", ret.status_code)
-        if ret.status_code != 200:
-            raise ProcessorError(
-                "Prod policy download failed: {} : {}".format(
-                    ret.status_code, url
-                )
-            )
-        prod = ET.fromstring(ret.text)
-        self.logger.debug(f"Prod: {prod}")
         self.logger.debug("Parsed XML from Install policy")
         prod.find(pack_base + "/id").text = self.pkg.idn
         prod.find(pack_base + "/name").text = self.pkg.name
-        data = ET.tostring(prod)
-        self.logger.debug("Parsed to XML for Install")
         self.logger.debug("About to put install policy %s", url)
-        ret = requests.put(
-            url, auth=self.auth, data=data, cookies=self.cookies
-        )
-        if ret.status_code != 201:
-            raise ProcessorError(
-                "Prod policy upload failed: {} : {}".format(
-                    ret.status_code, url
-                )
-            )
-
-    def patch(self):
-        """now we start on the patch definition"""
+        self.ctx.put(url, prod, "Prod policy upload failed")
+
+    def title_id(self, refresh=False):
+        """find the ID of our patch software title, from the title index
+        if it knows it, otherwise from the list of titles"""
+        if not refresh:
+            pst_id = self.titles.get(self.pkg.patch)
+            if pst_id:
+                return pst_id
         # download the list of titles
         url = self.base + "/patchsoftwaretitles"
-        ret = requests.get(url, auth=self.auth, cookies=self.cookies)
-        patch_def_software_version = ""
         self.logger.debug("About to request PST list %s", url)
-        if ret.status_code != 200:
-            raise ProcessorError(
-                "Patch list download failed: {} : {}".format(
-                    ret.status_code, url
-                )
-            )
-        root = ET.fromstring(ret.text)
-        # find title to get ID
-        root.findall("patch_software_title")
-        pst_id = 0
-        for ps_title in root.findall("patch_software_title"):
-            if ps_title.findtext("name") == self.pkg.patch:
-                pst_id = ps_title.findtext("id")
-                break
-        if pst_id == 0:
-            raise ProcessorError(
-                "Patch list did not contain title: {}".format(self.pkg.package)
-            )
+        root = self.ctx.fetch(url, "Patch list download failed")
+        pst_id = self.titles.update(root).get(self.pkg.patch)
+        if pst_id:
+            return pst_id
+        raise ProcessorError(
+            "Patch list did not contain title: {}".format(self.pkg.package)
+        )
+
+    def patch_policies(self, pst_id):
+        """find the IDs of the Stable and Test patch policies"""
+        # they are normally named after the title so the policy list we
+        # got in check_delta has them
+        policies = self.policy_list()
+        stable = policies.get(f"{self.pkg.patch} Stable")
+        test = policies.get(f"{self.pkg.patch} Test")
+        if stable is not None and test is not None:
+            return (stable, test)
+        # get the list of patch policies for our software title
+        url = (
+            self.base + "/patchpolicies/softwaretitleconfig/id/" + str(pst_id)
+        )
+        self.logger.debug("About to request patch list: %s", url)
+        root = self.ctx.fetch(url, "Patch policy list download failed")
+        for pol in root.findall("patch_policy"):
+            if "Stable" in pol.findtext("name"):
+                stable = pol.findtext("id")
+            if "Test" in pol.findtext("name"):
+                test = pol.findtext("id")
+        return (stable, test)
+
+    def definition(self, pst_id):
+        """add our package to its version in the patch definition and
+        return the version's software_version"""
         # get patch list for our title
         url = self.base + "/patchsoftwaretitles/id/" + str(pst_id)
         self.logger.debug("About to request PST by ID: %s", url)
-        ret = requests.get(url, auth=self.auth, cookies=self.cookies)
-        if ret.status_code != 200:
-            raise ProcessorError(
-                "Patch software download failed: {} : {}".format(
-                    str(pst_id), self.pkg.name
-                )
-            )
-        root = ET.fromstring(ret.text)
+        # titles can be huge so we stream it and stop at our version
+        ret = self.ctx.stream(url, "Patch software download failed", True)
+        if ret is None:
+            # the title has been replaced since we indexed it
+            self.titles.drop(self.pkg.patch)
+            pst_id = self.title_id(refresh=True)
+            url = self.base + "/patchsoftwaretitles/id/" + str(pst_id)
+            self.logger.debug("About to request PST by new ID: %s", url)
+            ret = self.ctx.stream(url, "Patch software download failed")
         # find the patch version that matches our version
-        done = False
-        for record in root.findall("versions/version"):
-            if self.pkg.version in record.findtext("software_version"):
-                patch_def_software_version = record.findtext(
-                    "software_version"
-                )
-                package = record.find("package")
-                add = ET.SubElement(package, "id")
-                add.text = self.pkg.idn
-                add = ET.SubElement(package, "name")
-                add.text = self.pkg.name
-                done = True
-                break
-        if not done:
+        record = find_version(ret, self.pkg.version)
+        if record is None:
             raise ProcessorError(
                 "Patch definition version not found: {} : {} : {}".format(
                     str(pst_id), self.pkg.name, self.pkg.version
                 )
             )
+        patch_def_software_version = record.findtext("software_version")
+        if not set_package(record, self.pkg.idn, self.pkg.name):
+            self.ctx.skip(url)
+            return patch_def_software_version
         # update the patch def
-        data = ET.tostring(root)
         self.logger.debug("About to put PST: %s", url)
-        ret = requests.put(
-            url, auth=self.auth, data=data, cookies=self.cookies
+        self.ctx.put(
+            url, title_document(record), "Patch definition update failed"
         )
-        if ret.status_code != 201:
-            raise ProcessorError(
-                "Patch definition update failed with code: %s"
-                % ret.status_code
-            )
-        # now the patch policy - this will be a journey as well
-        # first get the list of patch policies for our software title
-        url = (
-            self.base + "/patchpolicies/softwaretitleconfig/id/" + str(pst_id)
+        return patch_def_software_version
+
+    def stable_policy(self, pol_id):
+        """the Stable patch policy, fetched while the definition is
+        updated"""
+        if pol_id is None:
+            return None
+        url = self.base + "/patchpolicies/id/" + str(pol_id)
+        self.logger.debug("About to request Stable PP by ID: %s", url)
+        return (
+            url,
+            self.ctx.fetch(
+                url, "Patch policy download failed", subsets=PP_SUBSETS
+            ),
         )
-        self.logger.debug("About to request patch list: %s", url)
-        ret = requests.get(url, auth=self.auth)
-        if ret.status_code != 200:
-            raise ProcessorError(
-                "Patch policy list download failed: {} : {}".format(
-                    str(pst_id), self.pkg.name
-                )
-            )
-        root = ET.fromstring(ret.text)
-        pol_list = root.findall("patch_policy")
-        for pol in pol_list:
-            if "Stable" in pol.findtext("name"):
-                pol_id = pol.findtext("id")
-                # now grab that policy
-                url = self.base + "/patchpolicies/id/" + str(pol_id)
-                self.logger.debug("About to request Stable PP by ID: %s", url)
-                ret = requests.get(url, auth=self.auth, cookies=self.cookies)
-                if ret.status_code != 200:
-                    raise ProcessorError(
-                        "Patch policy download failed: {} : {}".format(
-                            str(pol_id), self.pkg.name
-                        )
-                    )
-                # now edit the patch policy
-                root = ET.fromstring(ret.text)
-                root.find(
-                    "general/target_version"
-                ).text = patch_def_software_version
-                root.find("general/release_date").text = ""
-                root.find(
-                    "user_interaction/deadlines/deadline_period"
-                ).text = str(self.pkg.deadline)
-                # create a description with date
-                now = datetime.datetime.now().strftime(" (%Y-%m-%d)")
-                root.find("user_interaction/self_service_description").text = (
-                    "Update " + self.pkg.package + now
-                )
-                data = ET.tostring(root)
-                self.logger.debug("About to update Stable PP: %s", url)
-                ret = requests.put(
-                    url, auth=self.auth, data=data, cookies=self.cookies
-                )
-                if ret.status_code != 201:
-                    raise ProcessorError(
-                        "Stable patch update failed with code: %s"
-                        % ret.status_code
-                    )
-            if "Test" in pol.findtext("name"):
-                pol_id = pol.findtext("id")
-                # now grab that policy
-                url = self.base + "/patchpolicies/id/" + str(pol_id)
-                self.logger.debug(
-                    "About to request Test PP by ID: %s URL: %s",
-                    str(pol_id),
-                    url,
-                )
-                ret = requests.get(url, auth=self.auth, cookies=self.cookies)
-                if ret.status_code != 200:
-                    raise ProcessorError(
-                        "Patch policy download failed: {} : {}".format(
-                            str(pol_id), self.pkg.name
-                        )
-                    )
-                # now disable the patch policy
-                root = ET.fromstring(ret.text)
-                root.find("general/enabled").text = "false"
-                data = ET.tostring(root)
-                self.logger.debug("About to update Test PP: %s", url)
-                ret = requests.put(
-                    url, auth=self.auth, data=data, cookies=self.cookies
-                )
-                if ret.status_code != 201:
-                    raise ProcessorError(
-                        "Test patch update failed with code: %s"
-                        % ret.status_code
-                    )
+
+    def stable(self, pol_id, software_version):
+        """point the Stable patch policy at our version"""
+        if pol_id is None:
+            return
+        (url, root) = self.stable_policy(pol_id)
+        # now edit the patch policy
+        root.find("general/target_version").text = software_version
+        root.find("general/release_date").text = ""
+        root.find(
+            "user_interaction/deadlines/deadline_period"
+        ).text = str(self.pkg.deadline)
+        # create a description with date
+        now = datetime.datetime.now().strftime(" (%Y-%m-%d)")
+        root.find("user_interaction/self_service_description").text = (
+            "Update " + self.pkg.package + now
+        )
+        self.logger.debug("About to update Stable PP: %s", url)
+        self.ctx.put(url, root, "Stable patch update failed")
+
+    def disable_test(self, pol_id):
+        """disable the Test patch policy"""
+        if pol_id is None:
+            return
+        # normally this is the one we read in check_delta
+        url = self.base + "/patchpolicies/id/" + str(pol_id)
+        self.logger.debug(
+            "About to request Test PP by ID: %s URL: %s", str(pol_id), url
+        )
+        root = self.ctx.fetch(
+            url, "Patch policy download failed", subsets=PP_SUBSETS
+        )
+        root.find("general/enabled").text = "false"
+        self.logger.debug("About to update Test PP: %s", url)
+        self.ctx.put(url, root, "Test patch update failed")
 
     def policy_list(self):
         """get the list of patch policies from JP and
         turn it into a dictionary"""
 
         url = self.base + "/patchpolicies"
-        ret = requests.get(
-            url, auth=self.auth, headers=self.hdrs, cookies=self.cookies
-        )
-        self.logger.debug(
-            "GET policy list url: %s status: %s" % (url, ret.status_code)
-        )
-        if ret.status_code != 200:
-            raise ProcessorError(
-                "GET failed URL: %s Err: %s" % (url, ret.status_code)
-            )
+        self.logger.debug("GET policy list url: %s", url)
+        policies = self.ctx.fetch(url, "GET failed", json=True)
         # turn the list into a dictionary keyed on the policy name
         d = {}
-        for p in ret.json()["patch_policies"]:
+        for p in policies["patch_policies"]:
             d[p["name"]] = p["id"]
         return d
 
     def policy(self, idn):
         """get a single patch policy"""
         url = self.base + "/patchpolicies/id/" + idn
-        ret = requests.get(
-            url, auth=self.auth, headers=self.hdrs, cookies=self.cookies
-        )
-        self.logger.debug(
-            "GET policy url: %s status: %s" % (url, ret.status_code)
+        self.logger.debug("GET policy url: %s", url)
+        # only the sections check_delta and the promotion need
+        return self.ctx.fetch(url, "GET failed", subsets=PP_SUBSETS)
+
+    def job(self, args):
+        """build a Package from a dictionary of recipe arguments"""
+        pkg = Package()
+        pkg.package = args.get("package")
+        if not pkg.package:
+            raise ProcessorError("No package in: {}".format(args))
+        pkg.patch = args.get("patch")
+        pkg.delta = args.get("delta")
+        if pkg.delta:
+            pkg.delta = int(pkg.delta)
+        else:
+            pkg.delta = DEFAULT_DELTA
+        pkg.deadline = args.get("deadline")
+        if pkg.deadline:
+            pkg.deadline = int(pkg.deadline)
+        else:
+            pkg.deadline = DEFAULT_DEADLINE
+        if not pkg.patch:
+            pkg.patch = pkg.package
+        return pkg
+
+    def promote(self):
+        """move self.pkg from test into production. Steps that don't
+        depend on each other run at the same time. Disabling the Test
+        patch policy marks the package as done so it waits for the rest,
+        if anything fails we try again next run."""
+        self.logger.debug("Passed delta. Package: %s", self.pkg.package)
+        run_steps(
+            {
+                "lookup": (lambda done: self.lookup(), []),
+                "install": (lambda done: self.install_policy(), []),
+                "production": (
+                    lambda done: self.production(),
+                    ["lookup", "install"],
+                ),
+                "title": (lambda done: self.title_id(), []),
+                "definition": (
+                    lambda done: self.definition(done["title"]),
+                    ["lookup", "title"],
+                ),
+                "policies": (
+                    lambda done: self.patch_policies(done["title"]),
+                    ["title"],
+                ),
+                "stable_get": (
+                    lambda done: self.stable_policy(done["policies"][0]),
+                    ["policies"],
+                ),
+                "stable": (
+                    lambda done: self.stable(
+                        done["policies"][0], done["definition"]
+                    ),
+                    ["definition", "stable_get"],
+                ),
+                "test": (
+                    lambda done: self.disable_test(done["policies"][1]),
+                    ["production", "stable"],
+                ),
+            }
         )
-        if ret.status_code != 200:
-            raise self.Error(
-                "GET failed URL: %s Err: %s" % (url, ret.status_code)
-            )
-        self.logger.debug("About to return from policy")
-        return ret.json()["patch_policy"]
+        self.logger.debug("Done patch")
 
+    @metrics.instrumented("production_summary_result")
+    @profiled
     def main(self):
         """Do it!"""
         self.setup_logging()
         (self.base, self.auth) = self.load_prefs()
+        self.ctx = Context(self.client)
         # clear any pre-exising summary result
         if "production_summary_result" in self.env:
             self.logger.debug("Clearing prev summary")
-            del self.env["prod_summary_result"]
-        self.pkg.package = self.env.get("package")
-        self.pkg.patch = self.env.get("patch")
-        self.pkg.delta = self.env.get("delta")
-        if self.pkg.delta:
-            self.pkg.delta = int(self.pkg.delta)
-        else:
-            self.pkg.delta = DEFAULT_DELTA
-        self.pkg.deadline = self.env.get("deadline")
-        if self.pkg.deadline:
-            self.pkg.deadline = int(self.pkg.deadline)
+            del self.env["production_summary_result"]
+        # in batch mode a single recipe hands us all the packages so the
+        # global lists are only downloaded once for the lot
+        batch = self.env.get("packages")
+        if batch:
+            jobs = [self.job(args) for args in batch]
         else:
-            self.pkg.deadline = DEFAULT_DEADLINE
-        self.logger.debug(f"Starting package {self.pkg.package}")
-        self.logger.debug(f"get. delta: {self.pkg.delta}")
-        if not self.pkg.patch:
-            self.pkg.patch = self.pkg.package
-        if self.pkg.patch.lower() == "none":
-            exit(0)
-        if self.check_delta():
-            self.logger.debug("Passed delta. Package: %s", self.pkg.package)
-            self.lookup()
-            self.production()
-            self.logger.debug(
-                "Post production self.pkg.patch: %s", self.pkg.patch
-            )
-            self.patch()
-            self.logger.debug("Done patch")
+            jobs = [self.job(self.env)]
+        jobs = [pkg for pkg in jobs if pkg.patch.lower() != "none"]
+        # check every delta first, then promote the ones that are due
+        due = []
+        errors = []
+        for pkg in jobs:
+            self.pkg = pkg
+            self.logger.debug("Starting package %s", self.pkg.package)
+            self.logger.debug("get. delta: %s", self.pkg.delta)
+            try:
+                if self.check_delta():
+                    due.append(pkg)
+            except ProcessorError as err:
+                if not batch:
+                    raise
+                errors.append(f"{pkg.package}: {err}")
+            except Exception as err:
+                if not batch:
+                    raise
+                # one title going wrong mustn't lose the others
+                errors.append(
+                    f"{pkg.package}: {type(err).__name__}: {err}"
+                )
+        done = []
+        for pkg in due:
+            self.pkg = pkg
+            try:
+                self.promote()
+                done.append(pkg)
+            except ProcessorError as err:
+                if not batch:
+                    raise
+                errors.append(f"{pkg.package}: {err}")
+            except Exception as err:
+                if not batch:
+                    raise
+                # one title going wrong mustn't lose the others
+                errors.append(
+                    f"{pkg.package}: {type(err).__name__}: {err}"
+                )
+        if done:
             self.env["production_summary_result"] = {
                 "summary_text": "The following updates were productionized:",
-                "report_fields": ["package", "version"],
+                "report_fields": ["package", "version", "writes_skipped"],
                 "data": {
-                    "package": self.pkg.package,
-                    "version": self.pkg.version,
+                    "package": ", ".join(pkg.package for pkg in done),
+                    "version": ", ".join(pkg.version for pkg in done),
+                    "writes_skipped": str(self.ctx.skipped),
                 },
             }
             self.logger.debug(
-                "Summary done: %s" % self.env["production_summary_result"]
+                "Summary done: %s", self.env["production_summary_result"]
             )
+        self.logger.info(
+            "%s packages, %s promoted, API calls: %s, writes skipped: %s",
+            len(jobs), len(done), self.ctx.calls, self.ctx.skipped
+        )
+        if errors:
+            raise ProcessorError("; ".join(errors))
 
 
 if __name__ == "__main__":
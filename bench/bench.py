@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+#
+# Benchmarks for the PatchBot processors
+
+"""Run the PatchBot processors against the stand-in Jamf server
+
+Each scenario gets a fresh stand-in server and an empty cache, runs one
+processor and reports the API round trips, the bytes sent and received
+and the wall time. Save the results with `--json` and compare a later
+run with `--compare` so changes in any of them show up in review.
+
+    python3 bench/bench.py --latency 0.05 --json before.json
+    python3 bench/bench.py --latency 0.05 --compare before.json
+
+The processors need `autopkglib` so run this with AutoPkg's Python, we
+also look for it where AutoPkg installs it. Everything, preferences,
+cache, metrics and profiles included, lives in a temporary home
+directory. The processors' log files aren't written.
+"""
+
+from os import path
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import plistlib
+import tempfile
+import importlib.util
+
+HERE = path.dirname(path.abspath(__file__))
+REPO = path.dirname(HERE)
+
+# where AutoPkg keeps autopkglib
+AUTOPKG_LIB = "/Library/AutoPkg"
+
+# the rate limits for the benchmark, high enough not to get in the way
+BENCH_RATE = 1000
+BENCH_INFLIGHT = 64
+
+SCENARIOS = (
+    "JPCImporter",
+    "PatchManager",
+    "PatchManager batch",
+    "Production",
+    "Production batch",
+)
+
+
+_modules = {}
+
+
+def prepare():
+    """Make a temporary home directory and our imports work. Returns the
+    home directory"""
+    home = tempfile.mkdtemp(prefix="patchbot-bench-")
+    # before anything works out where the cache lives
+    os.environ["HOME"] = home
+    # and the metrics and profiles with it
+    os.environ["PATCHBOT_METRICS_DIR"] = home
+    os.environ["PATCHBOT_PROFILE_DIR"] = home
+    os.makedirs(path.join(home, "Library", "Preferences"))
+    sys.path.insert(0, HERE)
+    sys.path.insert(0, REPO)
+    try:
+        import autopkglib  # noqa: F401
+    except ImportError:
+        sys.path.append(AUTOPKG_LIB)
+    return home
+
+
+def write_prefs(home, url):
+    """Point the AutoPkg preferences in `home` at the server at `url`"""
+    prefs = {
+        "JSS_URL": url,
+        "API_USERNAME": "bench",
+        "API_PASSWORD": "bench",
+        "PATCHBOT_RATE": BENCH_RATE,
+        "PATCHBOT_INFLIGHT": BENCH_INFLIGHT,
+    }
+    plist = path.join(
+        home, "Library", "Preferences", "com.github.autopkg.plist"
+    )
+    with open(plist, "wb") as fp:
+        plistlib.dump(prefs, fp)
+
+
+def module(name):
+    """The processor module `name`, loaded from the repository"""
+    if name not in _modules:
+        spec = importlib.util.spec_from_file_location(
+            name, path.join(REPO, name + ".py")
+        )
+        loaded = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(loaded)
+        # a handler stops setup_logging() adding the log file
+        logger = logging.getLogger(name)
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+        _modules[name] = loaded
+    return _modules[name]
+
+
+def processor(name):
+    """The processor class `name`"""
+    return getattr(module(name), name)
+
+
+class Bench:
+    """The scenarios and what they measured"""
+
+    def __init__(self, args):
+        self.args = args
+        self.home = prepare()
+        self.results = {}
+
+    def server(self):
+        """A fresh stand-in server, preferences pointing at it and an
+        empty cache"""
+        import fake_jamf
+
+        inv = fake_jamf.build(
+            self.args.titles, self.args.versions, self.args.policies
+        )
+        failures = [
+            fake_jamf.Failure(method, pattern, int(status), int(count))
+            for (method, pattern, status, count) in (
+                rule.split(":") for rule in self.args.fail
+            )
+        ]
+        server = fake_jamf.FakeJamf(inv, self.args.latency, failures).start()
+        write_prefs(self.home, server.url)
+        shutil.rmtree(path.join(self.home, "Library", "Caches"), True)
+        return server
+
+    def package(self):
+        """A package for a new version of Title0"""
+        pkg = path.join(self.home, "Title0-99.0.pkg")
+        with open(pkg, "wb") as fp:
+            fp.truncate(int(self.args.size * 1024 * 1024))
+        return pkg
+
+    def env(self, scenario):
+        """The recipe arguments for `scenario`"""
+        titles = min(self.args.batch, self.args.titles)
+        if scenario == "JPCImporter":
+            return {"pkg_path": self.package()}
+        if scenario.endswith("batch"):
+            return {
+                "packages": [
+                    {"package": "Title{}".format(i)} for i in range(titles)
+                ],
+                "rate": BENCH_RATE,
+            }
+        return {"package": "Title0"}
+
+    def run(self, scenario):
+        server = self.server()
+        job = processor(scenario.split()[0])(self.env(scenario))
+        error = None
+        start = time.perf_counter()
+        try:
+            job.main()
+        except Exception as err:
+            error = "{}: {}".format(type(err).__name__, err)
+        wall = time.perf_counter() - start
+        result = server.stats()
+        result["wall"] = round(wall, 3)
+        result["error"] = error
+        server.stop()
+        self.results[scenario] = result
+
+    def report(self, baseline=None):
+        print(
+            "{:<20} {:>6} {:>12} {:>12} {:>9}".format(
+                "scenario", "calls", "bytes in", "bytes out", "wall s"
+            )
+        )
+        for scenario, result in self.results.items():
+            line = "{:<20} {:>6} {:>12} {:>12} {:>9.3f}".format(
+                scenario,
+                result["calls"],
+                result["bytes_in"],
+                result["bytes_out"],
+                result["wall"],
+            )
+            old = (baseline or {}).get(scenario)
+            if old:
+                line += "  " + " ".join(
+                    "{} {}".format(key, change(old[key], result[key]))
+                    for key in ("calls", "bytes_out", "wall")
+                )
+            print(line)
+            if result["error"]:
+                print("    failed: {}".format(result["error"]))
+
+    def close(self):
+        shutil.rmtree(self.home, True)
+
+
+def change(old, new):
+    """`old` to `new` as a percentage"""
+    if not old:
+        return "n/a"
+    return "{:+.0f}%".format((new - old) * 100.0 / old)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to every call")
+    parser.add_argument("--titles", type=int, default=20)
+    parser.add_argument("--versions", type=int, default=50)
+    parser.add_argument("--policies", type=int, default=200,
+                        help="extra policies on the server")
+    parser.add_argument("--batch", type=int, default=10,
+                        help="titles in the batch scenarios")
+    parser.add_argument("--size", type=float, default=20,
+                        help="package size in MB")
+    parser.add_argument("--fail", action="append", default=[],
+                        metavar="METHOD:PATTERN:STATUS:COUNT",
+                        help="make matching calls fail, "
+                        "eg PUT:/packages/id/:409:3")
+    parser.add_argument("--only", action="append", choices=SCENARIOS)
+    parser.add_argument("--json", help="save the results here")
+    parser.add_argument("--compare", help="results saved by --json")
+    args = parser.parse_args()
+    bench = Bench(args)
+    try:
+        for scenario in args.only or SCENARIOS:
+            bench.run(scenario)
+    finally:
+        bench.close()
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+    bench.report(baseline)
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(bench.results, fp, indent=2)
+    return 1 if any(r["error"] for r in bench.results.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,621 @@
+#!/usr/bin/env python3
+#
+# A stand-in Jamf Pro server for benchmarks
+
+"""A local stand-in for the parts of the Jamf Pro API PatchBot uses
+
+It answers the Classic API calls for `policies`, `packages`,
+`patchsoftwaretitles` and `patchpolicies`, including `/subset/` and JSON
+where we use them, the bearer token endpoint, `/dbfileupload` and JCDS2
+multipart uploads through an S3 look-alike at `/bucket/`.
+
+Every call can be slowed down by `latency` seconds and `Failure` rules
+make matching calls fail a number of times. Request bodies are read in
+chunks and thrown away so big uploads don't use memory. Every call is
+logged with its status and the bytes each way.
+
+Run it on its own with
+
+    python3 bench/fake_jamf.py --titles 20 --latency 0.05 --port 8000
+"""
+
+import re
+import sys
+import json
+import time
+import socket
+import argparse
+import datetime
+import threading
+import xml.etree.ElementTree as ET
+from urllib.parse import unquote, urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# bytes read at a time from a request body
+READ_CHUNK = 1024 * 1024
+
+# Classic API list and list entry tags
+LISTS = {
+    "policies": ("policies", "policy"),
+    "packages": ("packages", "package"),
+    "patchsoftwaretitles": ("patch_software_titles", "patch_software_title"),
+    "patchpolicies": ("patch_policies", "patch_policy"),
+}
+
+# Classic API subset names to the XML sections they select
+SUBSETS = {
+    "General": "general",
+    "Scope": "scope",
+    "PackageConfiguration": "package_configuration",
+    "UserInteraction": "user_interaction",
+    "SelfService": "self_service",
+}
+
+
+class Failure:
+    """Fail the next `count` calls of `method` to a path matching
+    `pattern` with `status`"""
+
+    def __init__(self, method, pattern, status, count=1):
+        self.method = method
+        self.pattern = re.compile(pattern)
+        self.status = status
+        self.count = count
+
+    def matches(self, method, path):
+        return (
+            self.count > 0
+            and self.method in (method, "*")
+            and self.pattern.search(path)
+        )
+
+
+def version_number(n):
+    """The `n`th version of a generated title, 1.0, 1.1 ... 1.9, 2.0"""
+    return "{}.{}".format(n // 10 + 1, n % 10)
+
+
+class Titles:
+    """The patch software titles. A title's document is only built when
+    it is asked for so there can be thousands of titles with long
+    version histories"""
+
+    def __init__(self):
+        self.specs = {}  # id -> (name, versions or a number of versions)
+        self.made = {}  # id -> document
+
+    def add(self, idn, name, versions):
+        self.specs[idn] = (name, versions)
+        self.made.pop(idn, None)
+
+    def __contains__(self, idn):
+        return idn in self.specs
+
+    def __len__(self):
+        return len(self.specs)
+
+    def __getitem__(self, idn):
+        if idn not in self.made:
+            (name, versions) = self.specs[idn]
+            if isinstance(versions, int):
+                versions = [version_number(n) for n in range(versions)]
+            root = ET.Element("patch_software_title")
+            ET.SubElement(root, "id").text = str(idn)
+            ET.SubElement(root, "name").text = name
+            element = ET.SubElement(root, "versions")
+            for version in versions:
+                record = ET.SubElement(element, "version")
+                ET.SubElement(record, "software_version").text = version
+                ET.SubElement(record, "package")
+            self.made[idn] = root
+        return self.made[idn]
+
+    def items(self):
+        """(id, document) for every title. The documents of titles nobody
+        has asked for only have the name"""
+        for idn, (name, _) in self.specs.items():
+            root = self.made.get(idn)
+            if root is None:
+                root = ET.Element("patch_software_title")
+                ET.SubElement(root, "name").text = name
+            yield (idn, root)
+
+
+class Inventory:
+    """Everything on the server"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.policies = {}
+        self.packages = {}
+        self.titles = Titles()
+        self.patch_policies = {}
+        self.next_id = 100000
+        self.parts = {}  # S3 part number -> bytes
+        self.completed = False  # a multipart upload was completed
+
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    def add_title(self, idn, name, versions):
+        """Add a title with the list of `versions` or that many
+        generated ones"""
+        self.titles.add(idn, name, versions)
+
+    def add_package(self, idn, name):
+        root = ET.Element("package")
+        ET.SubElement(root, "id").text = str(idn)
+        ET.SubElement(root, "name").text = name
+        self.packages[idn] = root
+
+    def add_policy(self, idn, name, pkgid="", pkgname=""):
+        root = ET.Element("policy")
+        general = ET.SubElement(root, "general")
+        ET.SubElement(general, "id").text = str(idn)
+        ET.SubElement(general, "name").text = name
+        ET.SubElement(general, "enabled").text = "true"
+        ET.SubElement(root, "scope").text = "all computers"
+        packages = ET.SubElement(
+            ET.SubElement(root, "package_configuration"), "packages"
+        )
+        ET.SubElement(packages, "size").text = "1"
+        package = ET.SubElement(packages, "package")
+        ET.SubElement(package, "id").text = str(pkgid)
+        ET.SubElement(package, "name").text = pkgname
+        self.policies[idn] = root
+
+    def add_patch_policy(
+        self, idn, name, title_id, enabled="true", desc="", target=""
+    ):
+        root = ET.Element("patch_policy")
+        general = ET.SubElement(root, "general")
+        ET.SubElement(general, "id").text = str(idn)
+        ET.SubElement(general, "name").text = name
+        ET.SubElement(general, "enabled").text = enabled
+        ET.SubElement(general, "target_version").text = target
+        ET.SubElement(general, "release_date").text = ""
+        ET.SubElement(root, "scope").text = "all computers"
+        interaction = ET.SubElement(root, "user_interaction")
+        ET.SubElement(
+            interaction, "self_service_description"
+        ).text = desc
+        deadlines = ET.SubElement(interaction, "deadlines")
+        ET.SubElement(deadlines, "deadline_period").text = "7"
+        ET.SubElement(root, "software_title_configuration_id").text = str(
+            title_id
+        )
+        self.patch_policies[idn] = root
+
+
+def build(titles=10, versions=5, policies=0, days=10):
+    """An inventory of `titles` patch titles called Title0, Title1 ...
+    each with `versions` versions, the newest in test for `days` days.
+    Each title has a package for its two newest versions, a TEST and an
+    Install policy and a Test and Stable patch policy a version or two
+    behind. `policies` more
+    policies pad out the policy list"""
+    inv = Inventory()
+    tested = (
+        datetime.datetime.now() - datetime.timedelta(days=days)
+    ).strftime("(%Y-%m-%d)")
+    for i in range(titles):
+        name = "Title{}".format(i)
+        # only the newest three are used here
+        numbers = [
+            version_number(n) for n in range(max(0, versions - 3), versions)
+        ]
+        inv.add_title(10000 + i, name, versions)
+        new = "{}-{}.pkg".format(name, numbers[-1])
+        old = "{}-{}.pkg".format(name, numbers[-2] if versions > 1 else "0")
+        inv.add_package(20000 + i, new)
+        inv.add_package(30000 + i, old)
+        inv.add_policy(40000 + i, "TEST-" + name, 20000 + i, new)
+        inv.add_policy(50000 + i, "Install " + name, 30000 + i, old)
+        inv.add_patch_policy(
+            60000 + i,
+            name + " Test",
+            10000 + i,
+            "true",
+            "Update {} {}".format(name, tested),
+            numbers[-2] if versions > 1 else "",
+        )
+        inv.add_patch_policy(
+            70000 + i,
+            name + " Stable",
+            10000 + i,
+            "true",
+            "Update {} (2020-01-01)".format(name),
+            numbers[-3] if versions > 2 else "",
+        )
+    for i in range(policies):
+        inv.add_policy(80000 + i, "Policy {}".format(i))
+    return inv
+
+
+def to_json(element):
+    """The Classic API's JSON for a simple XML document"""
+    if len(element) == 0:
+        text = element.text or ""
+        if text in ("true", "false"):
+            return text == "true"
+        return int(text) if text.isdigit() else text
+    return {child.tag: to_json(child) for child in element}
+
+
+def find_named(store, name):
+    """ID of the object in `store` called `name`, the way Jamf matches
+    names without regard to case"""
+    name = name.lower()
+    for idn, root in store.items():
+        found = root.findtext("general/name") or root.findtext("name") or ""
+        if found.lower() == name:
+            return idn
+    return None
+
+
+class Handler(BaseHTTPRequestHandler):
+    """One connection to the stand-in"""
+
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeJamf/1.0"
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        # headers and body go in separate writes, without this Nagle
+        # and delayed ACKs add 40ms to every call
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    # plumbing
+
+    def setup_call(self):
+        self.sent = 0
+        self.received = 0
+        self.subset = None
+        self.status = None
+        time.sleep(self.server.latency)
+        for failure in self.server.failures:
+            with self.server.inv.lock:
+                hit = failure.matches(self.command, self.path)
+                if hit:
+                    failure.count -= 1
+            if hit:
+                self.drain()
+                self.reply(failure.status)
+                return False
+        return True
+
+    def reply(self, status, body=b"", ctype="application/xml", headers=()):
+        if isinstance(body, ET.Element):
+            if self.subset:
+                keep = ET.Element(body.tag)
+                keep.extend(c for c in body if c.tag in self.subset)
+                body = keep
+            body = ET.tostring(body)
+        elif isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+            ctype = "application/json"
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Set-Cookie", "AWSALB=node1; Path=/")
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.sent += len(body)
+        self.status = status
+        self.server.record(self)
+
+    def chunks(self):
+        """The request body a chunk at a time"""
+        if "chunked" in (self.headers.get("Transfer-Encoding") or ""):
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return
+                data = self.rfile.read(size)
+                self.rfile.readline()
+                self.received += len(data)
+                yield data
+        left = int(self.headers.get("Content-Length") or 0)
+        while left > 0:
+            data = self.rfile.read(min(left, READ_CHUNK))
+            if not data:
+                return
+            left -= len(data)
+            self.received += len(data)
+            yield data
+
+    def body(self):
+        return b"".join(self.chunks())
+
+    def drain(self):
+        """Read and throw away the body, returning its length"""
+        return sum(len(chunk) for chunk in self.chunks())
+
+    def wants_json(self):
+        return "json" in (self.headers.get("Accept") or "").lower()
+
+    def classic(self, path):
+        """(kind, by, key) of a Classic API path, taking off any subset"""
+        path = unquote(urlparse(path).path)
+        found = re.match(r"(.*)/subset/(.+)$", path)
+        if found:
+            path = found.group(1)
+            self.subset = {
+                SUBSETS.get(name, name.lower())
+                for name in found.group(2).split("&")
+            }
+        found = re.match(r"/JSSResource/(\w+)(?:/(\w+)/(.*))?$", path)
+        return found.groups() if found else (None, None, None)
+
+    def store(self, kind):
+        inv = self.server.inv
+        return {
+            "policies": inv.policies,
+            "packages": inv.packages,
+            "patchsoftwaretitles": inv.titles,
+            "patchpolicies": inv.patch_policies,
+        }.get(kind)
+
+    # the API
+
+    def do_GET(self):
+        if not self.setup_call():
+            return
+        if self.path == "/":
+            return self.reply(200, b"<html/>", "text/html")
+        (kind, by, key) = self.classic(self.path)
+        inv = self.server.inv
+        with inv.lock:
+            store = self.store(kind)
+            if store is None:
+                return self.reply(404)
+            if by is None:
+                return self.listing(kind, store)
+            if kind == "patchpolicies" and by == "softwaretitleconfig":
+                title = key.split("/")[-1]
+                found = ET.Element("patch_policies")
+                for idn, root in store.items():
+                    if root.findtext("software_title_configuration_id") == (
+                        title
+                    ):
+                        self.summary(found, "patch_policy", idn, root)
+                return self.reply(200, found)
+            idn = int(key) if by == "id" else find_named(store, key)
+            if idn not in store:
+                return self.reply(404)
+            if self.wants_json():
+                return self.reply(
+                    200, {kind[:-1]: to_json(store[idn])}
+                )
+            return self.reply(200, store[idn])
+
+    def summary(self, parent, tag, idn, root):
+        element = ET.SubElement(parent, tag)
+        ET.SubElement(element, "id").text = str(idn)
+        ET.SubElement(element, "name").text = root.findtext(
+            "general/name"
+        ) or root.findtext("name")
+
+    def listing(self, kind, store):
+        (name, tag) = LISTS[kind]
+        if self.wants_json():
+            return self.reply(
+                200,
+                {
+                    name: [
+                        {
+                            "id": idn,
+                            "name": root.findtext("general/name")
+                            or root.findtext("name"),
+                        }
+                        for idn, root in store.items()
+                    ]
+                },
+            )
+        found = ET.Element(name)
+        ET.SubElement(found, "size").text = str(len(store))
+        for idn, root in store.items():
+            self.summary(found, tag, idn, root)
+        return self.reply(200, found)
+
+    def do_PUT(self):
+        if not self.setup_call():
+            return
+        if self.path.startswith("/bucket/"):
+            return self.s3_part()
+        (kind, by, key) = self.classic(self.path)
+        data = ET.fromstring(self.body())
+        inv = self.server.inv
+        with inv.lock:
+            store = self.store(kind)
+            if store is None:
+                return self.reply(404)
+            idn = int(key) if by == "id" else find_named(store, key)
+            if idn not in store:
+                return self.reply(404)
+            if kind == "patchsoftwaretitles":
+                merge_versions(store[idn], data)
+            else:
+                merge(store[idn], data)
+        self.reply(
+            201, "<{0}><id>{1}</id></{0}>".format(kind[:-1], idn).encode()
+        )
+
+    def do_POST(self):
+        if not self.setup_call():
+            return
+        inv = self.server.inv
+        if self.path.startswith("/bucket/"):
+            self.drain()
+            if self.path.endswith("?uploads"):
+                return self.reply(
+                    200,
+                    b"<InitiateMultipartUploadResult><Bucket>bucket</Bucket>"
+                    b"<Key>k</Key><UploadId>UP1</UploadId>"
+                    b"</InitiateMultipartUploadResult>",
+                )
+            inv.completed = True
+            return self.reply(
+                200,
+                b"<CompleteMultipartUploadResult><Location>x</Location>"
+                b"<Bucket>bucket</Bucket><Key>k</Key><ETag>e</ETag>"
+                b"</CompleteMultipartUploadResult>",
+            )
+        if self.path == "/api/v1/auth/token":
+            self.drain()
+            return self.reply(
+                200, {"token": "t", "expires": "2099-01-01T00:00:00.000Z"}
+            )
+        if self.path == "/api/v1/jcds/files":
+            self.drain()
+            host = "http://{}:{}".format(*self.server.server_address)
+            return self.reply(
+                200,
+                {
+                    "accessKeyID": "a",
+                    "secretAccessKey": "b",
+                    "sessionToken": "c",
+                    "region": "us-east-1",
+                    "bucketName": "bucket",
+                    "path": "pkgs/",
+                    "uuid": "u",
+                    # only the stand-in sends this
+                    "endpointUrl": host,
+                },
+            )
+        if self.path == "/dbfileupload":
+            self.drain()
+            with inv.lock:
+                idn = inv.new_id()
+                inv.add_package(idn, self.headers["FILE_NAME"])
+            return self.reply(
+                201, "<package><id>{}</id></package>".format(idn).encode()
+            )
+        if self.path == "/JSSResource/packages/id/0":
+            data = ET.fromstring(self.body())
+            with inv.lock:
+                idn = inv.new_id()
+                ET.SubElement(data, "id").text = str(idn)
+                inv.packages[idn] = data
+            return self.reply(
+                201, "<package><id>{}</id></package>".format(idn).encode()
+            )
+        self.drain()
+        self.reply(404)
+
+    def s3_part(self):
+        number = int(parse_qs(urlparse(self.path).query)["partNumber"][0])
+        size = self.drain()
+        with self.server.inv.lock:
+            self.server.inv.parts[number] = size
+        self.reply(200, headers=[("ETag", '"etag{}"'.format(number))])
+
+
+def merge(old, new):
+    """Replace the sections of `old` that `new` has, the way a Classic
+    API PUT of part of an object does"""
+    for child in new:
+        found = old.find(child.tag)
+        if found is not None:
+            old.remove(found)
+        old.append(child)
+
+
+def merge_versions(old, new):
+    """Only the versions sent in a patch software title PUT change"""
+    versions = {
+        v.findtext("software_version"): v for v in old.find("versions")
+    }
+    for version in new.find("versions"):
+        target = versions.get(version.findtext("software_version"))
+        if target is not None:
+            target.remove(target.find("package"))
+            target.append(version.find("package"))
+
+
+class FakeJamf(ThreadingHTTPServer):
+    """The server. `log` has a (method, path, status, bytes in, bytes
+    out) tuple for every call"""
+
+    daemon_threads = True
+
+    def __init__(self, inv, latency=0, failures=(), port=0):
+        super().__init__(("127.0.0.1", port), Handler)
+        self.inv = inv
+        self.latency = latency
+        self.failures = list(failures)
+        self.log = []
+        self.log_lock = threading.Lock()
+        self.url = "http://127.0.0.1:{}".format(self.server_port)
+
+    def record(self, handler):
+        with self.log_lock:
+            self.log.append(
+                (
+                    handler.command,
+                    handler.path,
+                    handler.status,
+                    handler.received,
+                    handler.sent,
+                )
+            )
+
+    def stats(self):
+        """Calls and bytes so far"""
+        with self.log_lock:
+            return {
+                "calls": len(self.log),
+                "bytes_in": sum(entry[3] for entry in self.log),
+                "bytes_out": sum(entry[4] for entry in self.log),
+            }
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--titles", type=int, default=10)
+    parser.add_argument("--versions", type=int, default=5)
+    parser.add_argument("--policies", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument(
+        "--fail",
+        action="append",
+        default=[],
+        metavar="METHOD:PATTERN:STATUS:COUNT",
+        help="make matching calls fail, eg PUT:/packages/id/:409:3",
+    )
+    args = parser.parse_args()
+    failures = []
+    for rule in args.fail:
+        method, pattern, status, count = rule.split(":")
+        failures.append(Failure(method, pattern, int(status), int(count)))
+    inv = build(args.titles, args.versions, args.policies)
+    server = FakeJamf(inv, args.latency, failures, args.port)
+    print(
+        "Serving {} titles on {}".format(args.titles, server.url),
+        flush=True,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+#
+# Scale test for the PatchBot lookups
+
+"""How the PatchBot lookups cope with a big Jamf server
+
+For each size we start a stand-in server with that many patch titles,
+each with a long version history, plus their packages, policies and
+patch policies and more policies on top. Then we time the lookup and
+parse paths the processors use against it and measure their peak
+memory:
+
+ - title list, download the patch title list and rebuild the title
+   index from it (the `patch_software_title` scan)
+ - title lookup, find a title ID in the index on disk
+ - version scan, stream a title and find its newest version, the last
+   one in the list (the `versions/version` loop)
+ - patch policy list, Production's `policy_list()`
+ - package catalog, download the package list and find the newest
+   package for a title
+
+    python3 bench/scale.py --sizes 100 1000 10000 --versions 300
+
+Times are the best of `--repeat` runs. Memory is measured on a separate
+run with tracemalloc on as it slows everything down. The stand-in runs
+in its own process so it isn't counted. Like bench.py this needs
+AutoPkg's Python.
+"""
+
+from os import path
+import sys
+import time
+import shutil
+import logging
+import argparse
+import subprocess
+import tracemalloc
+
+from bench import HERE, prepare, write_prefs, module
+
+
+def start_server(titles, versions, policies):
+    """Start a stand-in server in a process of its own, returns (process,
+    url)"""
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            path.join(HERE, "fake_jamf.py"),
+            "--port", "0",
+            "--titles", str(titles),
+            "--versions", str(versions),
+            "--policies", str(policies),
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    line = server.stdout.readline()
+    if not line:
+        raise RuntimeError("The stand-in server didn't start")
+    return (server, line.split()[-1])
+
+
+class Steps:
+    """The lookups for one server"""
+
+    def __init__(self, titles, versions):
+        from PatchBotLib.client import parsed
+        from PatchBotLib.titles import TitleIndex
+        from PatchBotLib.catalog import Catalog
+        from PatchBotLib.patchtitle import find_version
+        from fake_jamf import version_number
+
+        self.parsed = parsed
+        self.find_version = find_version
+        self.Catalog = Catalog
+        production = module("Production")
+        self.context = production.Context
+        self.production = production.Production({})
+        self.production.logger = logging.getLogger("Production")
+        # this sets up the client from the preferences
+        (self.production.base, _) = self.production.load_prefs()
+        self.client = self.production.client
+        self.index = TitleIndex(self.client.server)
+        self.title = "Title{}".format(titles - 1)
+        self.title_id = 10000 + titles - 1
+        self.newest = version_number(versions - 1)
+
+    def title_list(self):
+        ret = self.client.get(self.client.base + "patchsoftwaretitles")
+        titles = self.index.update(self.parsed(ret))
+        assert self.title in titles
+
+    def title_lookup(self):
+        assert self.index.get(self.title)
+
+    def version_scan(self):
+        url = self.client.base + "patchsoftwaretitles/id/{}".format(
+            self.title_id
+        )
+        ret = self.client.get(url, stream=True)
+        record = self.find_version(ret, self.newest)
+        assert record.findtext("software_version") == self.newest
+
+    def patch_policy_list(self):
+        self.production.ctx = self.context(self.production.client)
+        policies = self.production.policy_list()
+        assert self.title + " Test" in policies
+
+    def package_catalog(self):
+        catalog = self.Catalog(self.client)
+        catalog.refresh()
+        assert catalog.latest(self.title)
+
+    STEPS = (
+        "title_list",
+        "title_lookup",
+        "version_scan",
+        "patch_policy_list",
+        "package_catalog",
+    )
+
+
+def measure(step, repeat):
+    """(best seconds, peak bytes) for `step`"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        step()
+        took = time.perf_counter() - start
+        best = took if best is None else min(best, took)
+    tracemalloc.start()
+    try:
+        step()
+        (_, peak) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return (best, peak)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[100, 1000, 10000],
+                        help="numbers of titles")
+    parser.add_argument("--versions", type=int, default=300,
+                        help="versions for each title")
+    parser.add_argument("--policies", type=float, default=1.0,
+                        help="extra policies for each title")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    home = prepare()
+    print(
+        "{:>7} {:<18} {:>10} {:>12}".format(
+            "titles", "step", "best ms", "peak KB"
+        )
+    )
+    try:
+        for size in args.sizes:
+            (server, url) = start_server(
+                size, args.versions, int(size * args.policies)
+            )
+            try:
+                write_prefs(home, url)
+                steps = Steps(size, args.versions)
+                for name in Steps.STEPS:
+                    (best, peak) = measure(getattr(steps, name), args.repeat)
+                    print(
+                        "{:>7} {:<18} {:>10.1f} {:>12.0f}".format(
+                            size, name.replace("_", " "), best * 1000,
+                            peak / 1024.0
+                        ),
+                        flush=True,
+                    )
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        shutil.rmtree(home, True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())